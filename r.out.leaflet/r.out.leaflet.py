@@ -44,19 +44,49 @@
 #%option G_OPT_M_DIR
 #% key: output
 #% label: Output directory
-#% description: Directory must exists and should be empty but this is not checked by the script. Some parts may fail if the files will be in the directory. Overwrite is not implemented yet.
+#% description: Directory must exists and should be empty unless the update flag is used. Some parts may fail if the files will be in the directory.
 #% guisection: Output
 #%end
 #%option
 #% key: epsg
 #% type: integer
 #% label: EPSG projection code
-#% description: EPSG code of the projection which will be used for projecting raster map. Leaflet by default uses Spherical Mercator (EPSG:3857).
+#% description: EPSG code of the projection which will be used for projecting raster map. Leaflet by default uses Spherical Mercator (EPSG:3857). With more codes, the output for each is in its own subdirectory.
 #% required: no
+#% multiple: yes
 #% options: 1-100000
 #% answer: 3857
 #%end
 #%option
+#% key: output_format
+#% type: string
+#% label: Format of the map layers
+#% description: Either one image for each map or XYZ tiles for each map (tiles require EPSG:3857)
+#% required: no
+#% options: image,tiles
+#% answer: image
+#% guisection: Output
+#%end
+#%option
+#% key: min_zoom
+#% type: integer
+#% label: Lowest zoom level of tiles
+#% description: Used only for tiles output format
+#% required: no
+#% answer: 0
+#% options: 0-24
+#% guisection: Output
+#%end
+#%option
+#% key: max_zoom
+#% type: integer
+#% label: Highest zoom level of tiles
+#% description: Used only for tiles output format. By default, it is derived from the resolution.
+#% required: no
+#% options: 0-24
+#% guisection: Output
+#%end
+#%option
 #% key: opacity
 #% type: integer
 #% label: Layer opacity
@@ -73,7 +103,7 @@
 #% description: Specifies which information about maps should be exported
 #% required: no
 #% multiple: yes
-#% options: legend, histogram, pie-histogram, info, statistics, thumbnail, geotiff, packed-map
+#% options: legend, histogram, pie-histogram, histogram-data, info, statistics, thumbnail, geotiff, packed-map
 #%end
 #%option
 #% key: compression
@@ -84,6 +114,86 @@
 #% answer: 6
 #% options: 0-9
 #%end
+#%option
+#% key: max_size
+#% type: integer
+#% label: Maximum width and height of the image
+#% description: The image is downsampled when it would be larger in any direction (the resolution is otherwise derived from the source resolution)
+#% required: no
+#% guisection: Output
+#% options: 1-
+#%end
+#%option G_OPT_M_DIR
+#% key: cache
+#% label: Directory for cache of reprojected images
+#% description: Images are reused when the map, region and all settings are the same as in a previous run
+#% required: no
+#%end
+#%option
+#% key: cache_size
+#% type: integer
+#% label: Maximum size of the cache in MB
+#% description: Least recently used images are removed from the cache when it is larger
+#% required: no
+#% answer: 1024
+#% options: 1-
+#%end
+#%option
+#% key: thumbnail_size
+#% type: integer
+#% label: Maximum width and height of thumbnails
+#% required: no
+#% answer: 200
+#% options: 1-
+#% guisection: Output
+#%end
+#%option
+#% key: metadata
+#% type: string
+#% label: Where to store additional information about layers
+#% description: Either in data_file.js or in a separate JSON file for each layer loaded by the web page when needed
+#% required: no
+#% options: inline,split
+#% answer: inline
+#% guisection: Output
+#%end
+#%option
+#% key: backend
+#% type: string
+#% label: Rendering backend
+#% description: Module used to create the image or in-process rendering using NumPy (by default, platform dependent)
+#% required: no
+#% options: r.out.png,d.rast,numpy
+#%end
+#%option
+#% key: warp
+#% type: string
+#% label: Reproject using a warp index with the given interpolation
+#% description: Source cells for the target region are computed once for all maps with the same region (instead of running r.proj for each map), the image is rendered using NumPy
+#% required: no
+#% options: nearest,bilinear
+#%end
+#%option G_OPT_MEMORYMB
+#% description: Maps which need more memory are rendered by blocks of rows (only for backend=numpy)
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% label: Number of parallel processes
+#% description: Maps are exported in parallel, each process uses its own temporary location
+#% required: no
+#% answer: 1
+#% options: 1-1024
+#%end
+#%option
+#% key: info_nprocs
+#% type: integer
+#% label: Number of threads for additional information of each map
+#% description: Additional information (legend, statistics, GeoTIFF, ...) is generated in parallel while the map is exported
+#% required: no
+#% answer: 1
+#% options: 1-1024
+#%end
 #%flag
 #% key: m
 #% label: Use map extent instead of current region
@@ -98,6 +208,26 @@
 #% key: w
 #% description: Output world file
 #%end
+#%flag
+#% key: z
+#% label: Write precompressed copies of text files
+#% description: Text files (data files, information, statistics) are also written compressed by gzip (.gz) and Brotli (.br) for web servers which can serve precompressed files
+#%end
+#%flag
+#% key: c
+#% label: Add hash of the content to the names of generated files
+#% description: Files with the same name never change, so they can be cached by web browsers and servers for a long time (they are listed in immutable-assets.json)
+#%end
+#%flag
+#% key: s
+#% label: Pack legends and thumbnails into sprite sheets
+#% description: Position of legend and thumbnail of each layer in the sheet is stored with the layer, so that the web page can load them all at once
+#%end
+#%flag
+#% key: u
+#% label: Update only changed layers
+#% description: Images and additional information are generated only when the map, region or settings changed since the last run (according to manifest.json in the output directory)
+#%end
 
 """
 Created on Fri Oct  4 17:17:49 2013
@@ -107,6 +237,10 @@ Created on Fri Oct  4 17:17:49 2013
 
 import os
 import sys
+import json
+import shutil
+import hashlib
+import time
 
 import grass.script as gs
 
@@ -117,71 +251,133 @@ gs.set_path(modulename='r.out.leaflet', dirname='routleaflet',
 
 from routleaflet.pngproj import (
     get_map_extent_for_file, map_extent_to_js_leaflet_list,
-    export_png_in_projection)
+    create_sessions, start_pool, worker_sessions)
+from routleaflet.cache import ExportCache, map_fingerprint
+from routleaflet.manifest import (
+    Manifest, product_record, is_product_current, rename_to_hashed,
+    remove_unused_files, hashed_name)
+from routleaflet.utils import get_region, Mapset
+from routleaflet.tiles import tile_path
+from routleaflet.sprites import SpriteSheets
+from routleaflet.tasks import TaskGraph
+from routleaflet.warp import SourceData
+from routleaflet.stats import compute_statistics
+from routleaflet.render import DEFAULT_THUMBNAIL_SIZE
+from routleaflet.metadata import (
+    layer_entry, layer_data, write_text_file, ensure_compressed_copies,
+    LayerListWriter, LAYER_DATA_DIRECTORY)
+import routleaflet.metadata as lmetadata
 import routleaflet.outputs as loutputs
 
 
+# the order of additional information in the output
+INFO_TYPES = ['legend', 'histogram', 'pie-histogram', 'histogram-data',
+              'info', 'statistics', 'thumbnail', 'geotiff', 'packed-map']
+# directory (relative to the output directory) for sprite sheets
+SPRITES_DIRECTORY = 'sprites'
+# additional information computed from the map statistics
+STATISTICS_INFOS = ['histogram', 'pie-histogram', 'histogram-data',
+                    'statistics']
+# name of the task which computes statistics for the infos above
+STATISTICS_TASK = 'map statistics'
+# information which depends on the projection (made from the image)
+PROJECTED_INFOS = ['thumbnail']
+# subdirectory of output for each projection (when there are more)
+EPSG_DIRECTORY = 'epsg{epsg}'
+# HTTP Cache-Control header for files with content hash in their names
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
 def ensure_dir(f):
     d = os.path.dirname(f)
     if not os.path.exists(d):
-        os.makedirs(d)
-
-
-def escape_endlines(text):
-    return text.replace('\n', '\\n')
-
+        try:
+            os.makedirs(d)
+        except OSError:
+            # directory created by another process or thread meanwhile
+            if not os.path.isdir(d):
+                raise
 
-def escape_quotes(text):
-    return text.replace('"', '\\"')
 
+def generate_infos(map_name, projected_png_file, output_directory,
+                   required_infos, attributes, env=None, files=None,
+                   statistics=None, thumbnail_size=DEFAULT_THUMBNAIL_SIZE):
+    """Generate additional information about the map
 
-def escape_backslashes(text):
-    return text.replace('\\', '\\\\')
-
+    Attributes for the layer are appended to the ``attributes`` list.
+    When ``files`` list is provided, paths of the generated files
+    (relative to ``output_directory``) are appended to it.
 
-def generate_infos(map_name, projected_png_file, output_directory,
-                   required_infos, attributes):
+    Statistics and histograms are created from ``statistics``
+    (see :func:`routleaflet.stats.compute_statistics`). When they are
+    not provided, they are computed here, so the map is read only once.
+    """
     histogram_width = 500
     histogram_height = 500
 
+    if statistics is None and set(required_infos) & set(STATISTICS_INFOS):
+        statistics = compute_statistics(map_name, env=env)
+
     if 'legend' in required_infos:
-        file_name = map_name + '.png'
-        file_path = os.path.join(output_directory, 'legends',
-                                 file_name)
-        ensure_dir(file_path)
+        legend_directory = os.path.join(output_directory, 'legends')
+        ensure_dir(os.path.join(legend_directory, map_name))
+        # maps with the same colors and range share one legend
         # let's use histogram size
-        loutputs.export_legend(map_name, file_path,
-                               width=histogram_width,
-                               height=histogram_height)
+        file_name = loutputs.export_shared_legend(map_name,
+                                                  legend_directory,
+                                                  width=histogram_width,
+                                                  height=histogram_height,
+                                                  env=env)
+        if files is not None:
+            files.append(os.path.join('legends', file_name))
         attributes.append(('legend', file_name))
 
     if 'histogram' in required_infos:
         file_name = map_name + '.png'
         file_path = os.path.join(output_directory, 'histograms',
                                  file_name)
+        if files is not None:
+            files.append(os.path.join('histograms', file_name))
         ensure_dir(file_path)
         loutputs.export_histogram(map_name, file_path,
                                   width=histogram_width,
-                                  height=histogram_height)
+                                  height=histogram_height, env=env,
+                                  statistics=statistics)
         attributes.append(('histogram', file_name))
 
     if 'pie-histogram' in required_infos:
         file_name = map_name + '.png'
         file_path = os.path.join(output_directory, 'pie-histograms',
                                  file_name)
+        if files is not None:
+            files.append(os.path.join('pie-histograms', file_name))
         ensure_dir(file_path)
         loutputs.export_histogram(map_name, file_path,
                                   width=histogram_width,
                                   height=histogram_height,
-                                  style='pie')
+                                  style='pie', env=env,
+                                  statistics=statistics)
         attributes.append(('piehistogram', file_name))
 
+    if 'histogram-data' in required_infos:
+        file_name = map_name + '.json'
+        file_path = os.path.join(output_directory, 'histogram-data',
+                                 file_name)
+        if files is not None:
+            files.append(os.path.join('histogram-data', file_name))
+        ensure_dir(file_path)
+        loutputs.export_histogram_data(map_name, file_path,
+                                       statistics=statistics, env=env)
+        attributes.append(('histogramdata', file_name))
+
     if 'info' in required_infos:
         file_name = map_name + '.txt'
         file_path = os.path.join(output_directory, 'infos',
                                  file_name)
+        if files is not None:
+            files.append(os.path.join('infos', file_name))
         ensure_dir(file_path)
-        loutputs.export_info(map_name, file_path)
+        loutputs.export_info(map_name, file_path, env=env)
         attributes.append(('infofile', file_name))
         with open(file_path, 'r') as data_file:
             content = data_file.read()
@@ -191,8 +387,11 @@ def generate_infos(map_name, projected_png_file, output_directory,
         file_name = map_name + '.txt'
         file_path = os.path.join(output_directory, 'statistics',
                                  file_name)
+        if files is not None:
+            files.append(os.path.join('statistics', file_name))
         ensure_dir(file_path)
-        loutputs.export_statistics(map_name, file_path)
+        loutputs.export_statistics(map_name, file_path, env=env,
+                                   statistics=statistics)
         attributes.append(('statisticsfile', file_name))
         with open(file_path, 'r') as data_file:
             content = data_file.read()
@@ -202,27 +401,573 @@ def generate_infos(map_name, projected_png_file, output_directory,
         file_name = map_name + '.png'
         file_path = os.path.join(output_directory, 'thumbnails',
                                  file_name)
+        if files is not None:
+            files.append(os.path.join('thumbnails', file_name))
         ensure_dir(file_path)
-        loutputs.thumbnail_image(projected_png_file, file_path)
+        loutputs.thumbnail_image(projected_png_file, file_path,
+                                 size=thumbnail_size)
         attributes.append(('thumbnail', file_name))
 
     if 'geotiff' in required_infos:
-        file_name = map_name + '.tif'  # r.out.tiff always uses this extension
+        file_name = map_name + '.tif'
         file_path = os.path.join(output_directory, 'geotiffs',
                                  file_name)
+        if files is not None:
+            files.append(os.path.join('geotiffs', file_name))
         ensure_dir(file_path)
-        loutputs.export_raster_as_geotiff(map_name, file_path)
+        loutputs.export_raster_as_geotiff(map_name, file_path, env=env)
         attributes.append(('geotiff', file_name))
 
     if 'packed-map' in required_infos:
         file_name = map_name + '.pack'
         file_path = os.path.join(output_directory, 'packed-maps',
                                  file_name)
+        if files is not None:
+            files.append(os.path.join('packed-maps', file_name))
         ensure_dir(file_path)
-        loutputs.export_raster_packed(map_name, file_path)
+        loutputs.export_raster_packed(map_name, file_path, env=env)
         attributes.append(('packedmap', file_name))
 
 
+def export_map(session, map_name, out_dir, infos,
+               compression, routpng_flags, use_region, max_size, cache,
+               backend=None, tiles=None, previous=None, compress=False,
+               hashed=False, thumbnail_size=DEFAULT_THUMBNAIL_SIZE,
+               info_nprocs=1, warp=None, memory=None, shared=None,
+               source=None):
+    """Export one map with all the required information
+
+    Returns the layer record for the manifest (see
+    :class:`routleaflet.manifest.Manifest`), True if the image was
+    taken from the cache (None if the image was not exported at all)
+    and a dictionary with the time spent on each product (in seconds).
+
+    The additional information which does not need the image is
+    generated in ``info_nprocs`` threads (see :class:`TaskGraph`)
+    while the image is exported.
+
+    When the ``previous`` layer record is provided, only products
+    with changed inputs or files are generated.
+
+    With ``compress``, precompressed copies of the text files are
+    written too (see :func:`routleaflet.metadata.ensure_compressed_copies`).
+    With ``hashed``, the generated files are renamed to names with
+    a hash of their content (see :func:`hash_file_names`).
+
+    The thumbnail is created together with the image (from the image
+    in memory or from the map read at low resolution), it is created
+    from the image file only when the image itself is up-to-date.
+
+    With ``warp``, the map is reprojected using a warp index with
+    the given interpolation method. The ``memory`` (in MB) limits
+    the memory used for rendering (see
+    :meth:`routleaflet.pngproj.ProjectionSession.export`).
+    The ``source`` (:class:`routleaflet.warp.SourceData`) keeps the map
+    read for another projection, so it is not read again.
+
+    The ``shared`` tuple contains an output directory and a layer record
+    of the same map exported into another projection in this run.
+    The information which does not depend on the projection is linked
+    from there instead of being generated again.
+
+    When ``tiles`` dictionary is provided, the map is exported as tiles
+    instead of one image. The dictionary contains ``min_zoom``,
+    ``max_zoom`` and ``nprocs`` (number of threads).
+
+    The global environment is not modified, so the function can be
+    called from more threads or processes at once (with one session for
+    each of them).
+    """
+    env = os.environ.copy()
+    if not use_region:
+        # region of the map is set only for the modules we call
+        # (not in the region file), so parallel exports don't collide
+        env['GRASS_REGION'] = gs.region_env(raster=map_name, env=env)
+    if '@' in map_name:
+        pure_map_name = map_name.split('@')[0]
+    else:
+        pure_map_name = map_name
+    # TODO: mixing current and map's mapset at this point
+    if '@' in map_name:
+        map_name, src_mapset_name = map_name.split('@')
+    else:
+        # TODO: maybe mapset is mandatory for those out of current mapset?
+        src_mapset_name = gs.gisenv(env=env)['MAPSET']
+    image_file_name = pure_map_name + '.png'
+    image_file_path = os.path.join(out_dir, image_file_name)
+    # TODO: skip writing to file and extract the information from
+    # function, or use object if function is so large
+    wgs84_file = image_file_path + '.wgs84'
+
+    # inputs which determine if the outputs need to be regenerated
+    src_mapset = Mapset(name=src_mapset_name, use_current=True, env=env)
+    region = get_region(env=env)
+    inputs = dict(fingerprint=map_fingerprint(src_mapset.mapset_path,
+                                              map_name),
+                  region=[region[name] for name in
+                          ('north', 'south', 'east', 'west',
+                           'rows', 'cols')])
+    if hashed:
+        # files with plain names cannot be reused and vice versa
+        inputs['hashed'] = True
+    image_key = ExportCache.key(product='image', epsg=session.epsg_code,
+                                compression=compression,
+                                flags=routpng_flags, max_size=max_size,
+                                backend=backend, warp=warp,
+                                tiles=(tiles and [tiles['min_zoom'],
+                                                  tiles['max_zoom']]),
+                                **inputs)
+
+    products = {}
+    # products which do not need the image are generated meanwhile
+    info_keys = {}
+    pending = []
+    for info in INFO_TYPES:
+        if info not in infos or info in PROJECTED_INFOS:
+            continue
+        info_keys[info] = ExportCache.key(product=info, **inputs)
+        if is_product_current(out_dir, previous, info, info_keys[info]):
+            products[info] = previous['products'][info]
+        else:
+            pending.append(info)
+    if shared:
+        shared_directory, shared_layer = shared
+        for info in list(pending):
+            if info in shared_layer['products']:
+                record = shared_layer['products'][info]
+                link_files(shared_directory, out_dir, record['files'])
+                products[info] = dict(record)
+                pending.remove(info)
+    graph = TaskGraph()
+    if set(pending) & set(STATISTICS_INFOS):
+        # all statistics and histograms are computed in one pass
+        graph.add(STATISTICS_TASK, compute_statistics, args=(map_name,),
+                  kwargs=dict(env=env.copy()))
+    for info in pending:
+        # each task has its own environment for rendering variables
+        graph.add(info, generate_product,
+                  args=(info, map_name, out_dir, env.copy()),
+                  depends=([STATISTICS_TASK]
+                           if info in STATISTICS_INFOS else []))
+    graph.start(info_nprocs)
+    image_start = time.time()
+
+    thumbnail_key = ExportCache.key(product='thumbnail', image=image_key,
+                                    size=thumbnail_size)
+    thumbnail_name = os.path.join('thumbnails', pure_map_name + '.png')
+    thumbnail_made = False
+
+    layer = dict(title=pure_map_name, file=image_file_name)
+    if tiles:
+        tiles_directory = os.path.join(out_dir, pure_map_name)
+        tiles_index = os.path.join(pure_map_name, 'tiles.json')
+        layer['file'] = pure_map_name + '/{z}/{x}/{y}.png'
+    if is_product_current(out_dir, previous, 'image', image_key):
+        products['image'] = previous['products']['image']
+        bounds = previous['bounds']
+        layer['file'] = previous['file']
+        if not tiles:
+            image_file_path = os.path.join(out_dir, previous['file'])
+        for key in ('min_zoom', 'max_zoom', 'overview'):
+            if key in previous:
+                layer[key] = previous[key]
+        cached = None
+        image_start = None
+    elif tiles:
+        if os.path.exists(tiles_directory):
+            # tiles from previous run might not be overwritten
+            shutil.rmtree(tiles_directory)
+        result = session.export_tiles(map_name=map_name,
+                                      src_mapset_name=src_mapset_name,
+                                      output_directory=tiles_directory,
+                                      compression=compression,
+                                      routpng_flags=routpng_flags,
+                                      min_zoom=tiles['min_zoom'],
+                                      max_zoom=tiles['max_zoom'],
+                                      nprocs=tiles['nprocs'],
+                                      backend=backend,
+                                      env=env)
+        bounds = map_extent_to_js_leaflet_list(result['extent'])
+        layer['min_zoom'] = result['min_zoom']
+        layer['max_zoom'] = result['max_zoom']
+        # the most detailed tile which shows the whole map
+        for zoom in sorted(result['tiles'], reverse=True):
+            if len(result['tiles'][zoom]) == 1:
+                x, y = result['tiles'][zoom][0]
+                layer['overview'] = os.path.relpath(
+                    tile_path(tiles_directory, zoom, x, y), out_dir)
+                break
+        ensure_dir(os.path.join(out_dir, tiles_index))
+        with open(os.path.join(out_dir, tiles_index), 'w') as index_file:
+            json.dump(dict((str(zoom), tile_list) for zoom, tile_list
+                           in result['tiles'].items()), index_file)
+        products['image'] = product_record(out_dir, image_key,
+                                           attributes=[],
+                                           files=[tiles_index])
+        cached = False
+    else:
+        if 'thumbnail' in infos:
+            thumbnail_file = os.path.join(out_dir, thumbnail_name)
+            ensure_dir(thumbnail_file)
+        else:
+            thumbnail_file = None
+        cached = session.export(map_name=map_name,
+                                src_mapset_name=src_mapset_name,
+                                output_file=image_file_path,
+                                compression=compression,
+                                routpng_flags=routpng_flags,
+                                wgs84_file=wgs84_file,
+                                use_region=True,
+                                max_size=max_size,
+                                cache=cache,
+                                backend=backend,
+                                thumbnail_file=thumbnail_file,
+                                thumbnail_size=thumbnail_size,
+                                warp=warp, memory=memory,
+                                source=source, env=env)
+        thumbnail_made = bool(thumbnail_file)
+
+        # it doesn't matter in which location we are, it just uses the
+        # current location, not tested for LL loc, assuming that to be nop.
+        map_extent = get_map_extent_for_file(wgs84_file)
+        bounds = map_extent_to_js_leaflet_list(map_extent)
+        if hashed:
+            image_file_name = hash_file_names(out_dir, [image_file_name])[0]
+            image_file_path = os.path.join(out_dir, image_file_name)
+            layer['file'] = image_file_name
+        products['image'] = product_record(
+            out_dir, image_key, attributes=[],
+            files=[image_file_name, os.path.basename(wgs84_file)],
+            immutable=[image_file_name] if hashed else None)
+
+    timings = {}
+    if image_start is not None:
+        timings['image'] = time.time() - image_start
+    if tiles:
+        # additional information (thumbnail) is made from overview tile
+        if 'overview' in layer:
+            image_file_path = os.path.join(out_dir, layer['overview'])
+        else:
+            image_file_path = None
+    # generated products as (info, attributes, files)
+    generated = []
+    info_keys['thumbnail'] = thumbnail_key
+    if 'thumbnail' in infos and not image_file_path:
+        gs.warning(_("No tile with the whole map <{}> for thumbnail"
+                     " (use lower min_zoom)").format(map_name))
+    elif 'thumbnail' in infos and thumbnail_made:
+        generated.append(
+            ('thumbnail', [('thumbnail', os.path.basename(thumbnail_name))],
+             [thumbnail_name]))
+    elif 'thumbnail' in infos and is_product_current(
+            out_dir, previous, 'thumbnail', thumbnail_key):
+        products['thumbnail'] = previous['products']['thumbnail']
+    elif 'thumbnail' in infos:
+        # thumbnail is made from the image
+        start = time.time()
+        generated.append(('thumbnail',) + generate_product(
+            'thumbnail', map_name, out_dir, env,
+            projected_png_file=image_file_path,
+            thumbnail_size=thumbnail_size))
+        timings['thumbnail'] = time.time() - start
+    results = graph.wait()
+    timings.update(graph.timings)
+    generated.extend((info,) + results[info] for info in pending)
+    for info, attributes, files in generated:
+        if hashed and info != 'legend':
+            # legends are shared and already named by their inputs
+            files = hash_file_names(out_dir, files, attributes)
+            immutable = files
+        else:
+            # names of legends do not change when only the rendering
+            # changes, so they cannot be cached forever
+            immutable = None
+        products[info] = product_record(out_dir, info_keys[info],
+                                        files=files, attributes=attributes,
+                                        immutable=immutable)
+    layer['bounds'] = bounds
+    layer['products'] = products
+    if compress:
+        for product in products.values():
+            for name in product['files']:
+                ensure_compressed_copies(os.path.join(out_dir, name))
+    return layer, cached, timings
+
+
+def generate_product(info, map_name, output_directory, env,
+                     statistics=None, projected_png_file=None,
+                     thumbnail_size=DEFAULT_THUMBNAIL_SIZE):
+    """Generate one additional information (a task of :class:`TaskGraph`)
+
+    :returns: tuple with attributes and files as from
+        :func:`generate_infos`
+    """
+    attributes = []
+    files = []
+    generate_infos(map_name=map_name, projected_png_file=projected_png_file,
+                   output_directory=output_directory,
+                   required_infos=[info], attributes=attributes, env=env,
+                   files=files, statistics=statistics,
+                   thumbnail_size=thumbnail_size)
+    return attributes, files
+
+
+def link_files(source_directory, directory, files):
+    """Link (or copy) files from one output directory to another
+
+    The precompressed copies of the files are linked too.
+    Existing files are replaced.
+    """
+    for name in files:
+        for suffix in ('', '.gz', '.br'):
+            source = os.path.join(source_directory, name + suffix)
+            if suffix and not os.path.exists(source):
+                continue
+            destination = os.path.join(directory, name + suffix)
+            ensure_dir(destination)
+            if os.path.exists(destination):
+                os.remove(destination)
+            try:
+                os.link(source, destination)
+            except (OSError, AttributeError):
+                # different file system or no links on the platform
+                shutil.copy2(source, destination)
+
+
+def export_map_targets(sessions, map_name, targets, **kwargs):
+    """Export one map into all the target projections
+
+    The information which does not depend on the projection is generated
+    only for the first target and linked into the other output
+    directories (see :func:`export_map`). With ``warp``, the map is read
+    only once for all the targets.
+
+    :param sessions: dictionary with EPSG codes as keys
+        and :class:`ProjectionSession` objects as values
+    :param targets: list of tuples with EPSG code, output directory
+        and the previous layer record (or None)
+    :returns: list with the result of :func:`export_map` for each target
+    """
+    results = []
+    shared = None
+    if kwargs.get('warp') and len(targets) > 1:
+        source = SourceData(memory=kwargs.get('memory'),
+                            directory=sessions[targets[0][0]].warp_directory)
+    else:
+        source = None
+    try:
+        for epsg, out_dir, previous in targets:
+            result = export_map(sessions[epsg], map_name, out_dir,
+                                previous=previous, shared=shared,
+                                source=source, **kwargs)
+            if shared is None:
+                shared = (out_dir, result[0])
+            results.append(result)
+    finally:
+        if source:
+            source.close()
+    return results
+
+
+def hash_file_names(out_dir, files, attributes=None):
+    """Rename files to names with a hash of their content
+
+    Attributes (list of name-value pairs) with a value which is one
+    of the original file names (without directory) are updated to
+    the new names.
+
+    Returns list of the new file names (relative to ``out_dir``).
+    """
+    renamed = {}
+    new_files = []
+    for name in files:
+        new_name = rename_to_hashed(out_dir, name)
+        renamed[os.path.basename(name)] = os.path.basename(new_name)
+        new_files.append(new_name)
+    for i, (key, value) in enumerate(attributes or []):
+        if value in renamed:
+            attributes[i] = (key, renamed[value])
+    return new_files
+
+
+def write_layer_metadata(out_dir, layer, opacity, split, compress,
+                         hashed=False):
+    """Returns entry of the layer for data_file.js
+
+    With ``split``, the additional attributes are written to a separate
+    JSON file and the entry contains only the path to it
+    (with ``hashed``, the name contains hash of the content).
+    """
+    extra_attributes = layer_attributes(layer)
+    if split and extra_attributes:
+        content = layer_data(extra_attributes)
+        layer_file = '{directory}/{name}.json'.format(
+            directory=LAYER_DATA_DIRECTORY, name=layer['title'])
+        if hashed:
+            layer_file = hashed_name(
+                layer_file,
+                hashlib.sha1(content.encode('utf-8')).hexdigest())
+        layer_path = os.path.join(out_dir, layer_file)
+        ensure_dir(layer_path)
+        write_text_file(layer_path, content, compress=compress)
+        return layer_entry(layer, opacity, data_file=layer_file)
+    return layer_entry(layer, opacity, attributes=extra_attributes)
+
+
+def layer_attributes(layer):
+    """Returns additional attributes of a layer in a stable order"""
+    attributes = []
+    for product in ['image'] + INFO_TYPES:
+        if product in layer['products']:
+            attributes.extend(
+                tuple(pair)
+                for pair in layer['products'][product]['attributes'])
+    return attributes
+
+
+def add_sprites(entry, layer, out_dir, sprite_sheets):
+    """Add images of the layer to sprite sheets
+
+    :param sprite_sheets: dictionary with products (``legend``,
+        ``thumbnail``) as keys and :class:`SpriteSheets` as values
+    """
+    for product, sheets in sprite_sheets.items():
+        record = layer['products'].get(product)
+        if not record:
+            continue
+        for name in sorted(record['files']):
+            if not name.endswith('.png'):
+                continue
+            sprite = sheets.add(os.path.join(out_dir, name))
+            if sprite:
+                sprite['sheet'] = '{directory}/{sheet}'.format(
+                    directory=SPRITES_DIRECTORY, sheet=sprite['sheet'])
+                entry[product + 'Sprite'] = sprite
+            break
+
+
+class TargetDirectory(object):
+    """Output directory with layers in one projection
+
+    The layers are added as the maps are finished. The data files are
+    written in the order of the maps (see :class:`LayerListWriter`).
+    The manifest, sprite sheets and the list of immutable files are
+    written by :meth:`close`.
+
+    With sprites and hashed names, the names of the sheets are known
+    only when all the layers are added, so the entries are kept
+    and written by :meth:`close`.
+    """
+    def __init__(self, directory, maps, opacities, split, compress, hashed,
+                 sprites=False, compression=None):
+        self.directory = directory
+        self.maps = maps
+        self.opacities = opacities
+        self.split = split
+        self.compress = compress
+        self.hashed = hashed
+        self.manifest = Manifest(directory)
+        self.previous_files = self.manifest.files()
+        if sprites:
+            sprites_directory = os.path.join(directory, SPRITES_DIRECTORY)
+            if not os.path.exists(sprites_directory):
+                os.makedirs(sprites_directory)
+            self.sprite_sheets = dict(
+                legend=SpriteSheets(sprites_directory, 'legends',
+                                    compression=compression),
+                thumbnail=SpriteSheets(sprites_directory, 'thumbnails',
+                                       compression=compression))
+            # images are packed in the order of the layers
+            prepare = self._add_sprites
+        else:
+            self.sprite_sheets = None
+            prepare = None
+        if sprites and hashed:
+            self._entries = {}
+            prepare = None
+        else:
+            self._entries = None
+        # data files replace the old ones only when all is done
+        self.writer = LayerListWriter(directory, len(maps),
+                                      compress=compress, prepare=prepare)
+
+    def _add_sprites(self, index, entry):
+        add_sprites(entry, self.manifest.get_layer(self.maps[index]),
+                    self.directory, self.sprite_sheets)
+
+    def add(self, index, layer):
+        """Add layer of the map with the given index"""
+        self.manifest.set_layer(self.maps[index], layer)
+        entry = write_layer_metadata(self.directory, layer,
+                                     opacity=self.opacities[index],
+                                     split=self.split,
+                                     compress=self.compress,
+                                     hashed=self.hashed)
+        if 'data' in entry:
+            # recorded, so that the file is removed when not used anymore
+            layer['products']['metadata'] = product_record(
+                self.directory, key=entry['data'], files=[entry['data']],
+                attributes=[],
+                immutable=[entry['data']] if self.hashed else None)
+        if self._entries is not None:
+            self._entries[index] = entry
+        else:
+            self.writer.add(index, entry)
+
+    def close(self):
+        """Write all files and remove files which are not used anymore"""
+        if self._entries is not None:
+            for index in sorted(self._entries):
+                self._add_sprites(index, self._entries[index])
+        if self.sprite_sheets:
+            sheet_files = {}
+            for sheets in self.sprite_sheets.values():
+                for sheet, file_name in sheets.save(
+                        hashed=self.hashed).items():
+                    sheet_files['{directory}/{sheet}'.format(
+                        directory=SPRITES_DIRECTORY, sheet=sheet)] = \
+                        '{directory}/{file}'.format(
+                            directory=SPRITES_DIRECTORY, file=file_name)
+            # recorded, so that the sheets which are not used are removed
+            files = sorted(sheet_files.values())
+            self.manifest.products['sprites'] = product_record(
+                self.directory, key='sprites', files=files, attributes=[],
+                immutable=files if self.hashed else None)
+        else:
+            self.manifest.products.pop('sprites', None)
+        if self._entries is not None:
+            for index in sorted(self._entries):
+                entry = self._entries[index]
+                for product in self.sprite_sheets:
+                    sprite = entry.get(product + 'Sprite')
+                    if sprite:
+                        sprite['sheet'] = sheet_files[sprite['sheet']]
+                self.writer.add(index, entry)
+        self.writer.close()
+        self.manifest.keep_only(self.maps)
+        self.manifest.save()
+        # files are removed only now because some are shared by more layers
+        remove_unused_files(self.directory, self.previous_files,
+                            self.manifest.files())
+        if self.hashed:
+            # list of files which can be cached "forever"
+            immutable = self.manifest.immutable_files()
+            write_text_file(
+                os.path.join(self.directory, 'immutable-assets.json'),
+                json.dumps({'cache_control': IMMUTABLE_CACHE_CONTROL,
+                            'files': immutable}, indent=1) + '\n',
+                compress=self.compress)
+
+    def discard(self):
+        """Keep the files from the previous run"""
+        self.writer.discard()
+
+
+def export_map_worker(indexed_kwargs):
+    index, kwargs = indexed_kwargs
+    return index, export_map_targets(worker_sessions(), **kwargs)
+
+
 def main():
     options, flags = gs.parser()
 
@@ -286,7 +1031,10 @@ def main():
         gs.fatal(_("Output path <%s> does not exists."
                    " You need to create the (empty) output directory"
                    " yourself before running this module.") % out_dir)
-    epsg = int(options['epsg'])
+    epsg_codes = []
+    for code in options['epsg'].split(','):
+        if int(code) not in epsg_codes:
+            epsg_codes.append(int(code))
 
     if ',' in options['opacity']:
         opacities = [float(opacity)
@@ -303,11 +1051,17 @@ def main():
     else:
         infos = [options['info']]
 
-    if 'geotiff' in infos and not gs.find_program('r.out.tiff', '--help'):
-        gs.fatal(_("Install r.out.tiff add-on module to export GeoTIFF"))
-
     # r.out.png options
     compression = int(options['compression'])
+    if options['max_size']:
+        max_size = int(options['max_size'])
+    else:
+        max_size = None
+    if options['cache']:
+        cache = ExportCache(options['cache'],
+                            max_size=int(options['cache_size']) * 1024 ** 2)
+    else:
+        cache = None
     # flag w is passed to r.out.png.proj
     # our flag n is inversion of r.out.png.proj's t flag
     # (transparent NULLs are better for overlay)
@@ -321,85 +1075,123 @@ def main():
     # and is specified bellow
 
     if flags['m']:
-        use_region = False
         # we will use map extent
-        gs.use_temp_region()
+        use_region = False
     else:
         use_region = True
 
-    # hard coded file names
-    data_file_name = 'data_file.csv'
-    js_data_file_name = 'data_file.js'
-
-    data_file = open(os.path.join(out_dir, data_file_name), 'w')
-    js_data_file = open(os.path.join(out_dir, js_data_file_name), 'w')
-    js_data_file.write('/* This file was generated by r.out.leaflet GRASS GIS'
-                       ' module. */\n\n')
-    js_data_file.write('var layerInfos = [\n')
-
-    for i, map_name in enumerate(maps):
-        if not use_region:
-            gs.run_command('g.region', rast=map_name)
-        if '@' in map_name:
-            pure_map_name = map_name.split('@')[0]
-        else:
-            pure_map_name = map_name
-        # TODO: mixing current and map's mapset at this point
-        if '@' in map_name:
-            map_name, src_mapset_name = map_name.split('@')
+    nprocs = min(int(options['nprocs']), num_maps)
+    update = flags['u']
+    compress = flags['z']
+    hashed = flags['c']
+    if compress and lmetadata.brotli is None:
+        gs.warning(_("Install brotli Python package to create .br files"
+                     " (only .gz files will be created)"))
+
+    if options['output_format'] == 'tiles':
+        if epsg_codes != [3857]:
+            gs.fatal(_("Tiles can be created only in EPSG:3857"
+                       " (Spherical Mercator)"))
+        # the processes which are not used for maps render tiles
+        tiles = dict(min_zoom=int(options['min_zoom']),
+                     max_zoom=(int(options['max_zoom'])
+                               if options['max_zoom'] else None),
+                     nprocs=max(1, int(options['nprocs']) // nprocs))
+        if cache:
+            gs.warning(_("Cache is not used for tiles"))
+        if options['warp']:
+            gs.fatal(_("Option warp cannot be used for tiles"))
+    else:
+        tiles = None
+
+    # sessions are created before the target directories start writing
+    # temporary files, so an invalid projection leaves no files behind
+    sessions = create_sessions(nprocs, epsg_codes,
+                               warp=bool(options['warp']))
+
+    # each projection has its own directory when there are more
+    directories = []
+    for epsg in epsg_codes:
+        if len(epsg_codes) > 1:
+            directory = os.path.join(out_dir,
+                                     EPSG_DIRECTORY.format(epsg=epsg))
+            if not os.path.exists(directory):
+                os.mkdir(directory)
         else:
-            # TODO: maybe mapset is mandatory for those out of current mapset?
-            src_mapset_name = gs.gisenv()['MAPSET']
-        image_file_name = pure_map_name + '.png'
-        image_file_path = os.path.join(out_dir, image_file_name)
-        # TODO: skip writing to file and extract the information from
-        # function, or use object if function is so large
-        wgs84_file = image_file_path + '.wgs84'
-        export_png_in_projection(map_name=map_name,
-                                 src_mapset_name=src_mapset_name,
-                                 output_file=image_file_path,
-                                 epsg_code=epsg,
-                                 compression=compression,
-                                 routpng_flags=routpng_flags,
-                                 wgs84_file=wgs84_file,
-                                 use_region=True)
-
-        data_file.write(pure_map_name + ',' + image_file_name + '\n')
-
-        # it doesn't matter in which location we are, it just uses the current
-        # location, not tested for LL loc, assuming that to be nop.
-        map_extent = get_map_extent_for_file(wgs84_file)
-        bounds = map_extent_to_js_leaflet_list(map_extent)
+            directory = out_dir
+        directories.append(TargetDirectory(
+            directory, maps, opacities=opacities,
+            split=options['metadata'] == 'split', compress=compress,
+            hashed=hashed, sprites=flags['s'], compression=compression))
+
+    export_kwargs = [dict(map_name=map_name, infos=infos,
+                          compression=compression,
+                          routpng_flags=routpng_flags,
+                          use_region=use_region, max_size=max_size,
+                          cache=cache, backend=options['backend'] or None,
+                          tiles=tiles, compress=compress, hashed=hashed,
+                          thumbnail_size=int(options['thumbnail_size']),
+                          info_nprocs=int(options['info_nprocs']),
+                          warp=options['warp'] or None,
+                          memory=int(options['memory']),
+                          targets=[(epsg, directory.directory,
+                                    (directory.manifest.get_layer(map_name)
+                                     if update else None))
+                                   for epsg, directory
+                                   in zip(epsg_codes, directories)])
+                     for map_name in maps]
+    if nprocs > 1:
+        pool = start_pool(sessions)
+        # results come as the maps are finished
+        results = pool.imap_unordered(export_map_worker,
+                                      enumerate(export_kwargs))
+    else:
+        pool = None
+        results = ((i, export_map_targets(sessions[0], **kwargs))
+                   for i, kwargs in enumerate(export_kwargs))
 
-        extra_attributes = []
-
-        generate_infos(map_name=map_name,
-                       projected_png_file=image_file_path,
-                       required_infos=infos,
-                       output_directory=out_dir,
-                       attributes=extra_attributes)
-        # http://www.w3schools.com/js/js_objects.asp
-        js_data_file.write("""   {{title: "{title}", file: "{file_}","""
-                           """ bounds: {bounds}, opacity: {opacity}"""
-                           .format(title=pure_map_name,
-                                   file_=image_file_name,
-                                   bounds=bounds,
-                                   opacity=opacities[i]))
-        if extra_attributes:
-            extra_js_attributes = [pair[0] + ': "' +
-                                   escape_quotes(
-                                       escape_endlines(
-                                           escape_backslashes(
-                                               pair[1]
-                                           ))) + '"'
-                                   for pair in extra_attributes]
-            js_data_file.write(', ' + ', '.join(extra_js_attributes))
-        js_data_file.write("""}\n""")
-        # do not write after the last item
-        if i < num_maps - 1:
-            js_data_file.write(',')
-    js_data_file.write('];\n')
-    data_file.close()
+    num_cached = 0
+    num_exported = 0
+    # total time spent on each product
+    timings = {}
+    completed = False
+    try:
+        for i, map_results in results:
+            for directory, (layer, cached, map_timings) in zip(directories,
+                                                               map_results):
+                directory.add(i, layer)
+                for product, seconds in map_timings.items():
+                    timings[product] = timings.get(product, 0) + seconds
+                if cached is not None:
+                    num_exported += 1
+                if cached:
+                    num_cached += 1
+        completed = True
+    finally:
+        if not completed:
+            # the files from the previous run stay
+            for directory in directories:
+                directory.discard()
+    if pool:
+        pool.close()
+        pool.join()
+    for directory in directories:
+        directory.close()
+    if update:
+        gs.message(_("{num} of {total} images were updated").format(
+            num=num_exported, total=num_maps * len(directories)))
+    if cache:
+        # the counts from the worker processes
+        cache.report(hits=num_cached, misses=num_exported - num_cached)
+    if timings:
+        for product in sorted(timings, key=timings.get, reverse=True):
+            gs.verbose(_("Time spent on {product}: {seconds:.2f} s").format(
+                product=product, seconds=timings[product]))
+        product = max(timings, key=timings.get)
+        gs.message(_("Most of the time was spent on {product}"
+                     " ({seconds:.1f} s of {total:.1f} s)").format(
+                         product=product, seconds=timings[product],
+                         total=sum(timings.values())))
 
 
 if __name__ == '__main__':
@@ -23,15 +23,18 @@
 #% keywords: projection
 #%end
 #%option G_OPT_R_INPUT
+#% required: no
 #%end
 #%option G_OPT_F_OUTPUT
+#% required: no
 #%end
 #%option
 #% key: epsg
 #% type: integer
 #% label: EPSG projection code
-#% description: EPSG code of the projection which will be used for projecting raster map, e.g. '3857' for Spherical Mercator.
-#% required: yes
+#% description: EPSG code of the projection which will be used for projecting raster map, e.g. '3857' for Spherical Mercator. With more codes, the image for each is in its own subdirectory.
+#% required: no
+#% multiple: yes
 #% options: 1-100000
 #%end
 #%option
@@ -43,6 +46,72 @@
 #% answer: 6
 #% options: 0-9
 #%end
+#%option
+#% key: max_size
+#% type: integer
+#% label: Maximum width and height of the image
+#% description: The image is downsampled when it would be larger in any direction (the resolution is otherwise derived from the source resolution)
+#% required: no
+#% options: 1-
+#%end
+#%option G_OPT_M_DIR
+#% key: cache
+#% label: Directory for cache of reprojected images
+#% description: Images are reused when the map, region and all settings are the same as in a previous run
+#% required: no
+#%end
+#%option
+#% key: cache_size
+#% type: integer
+#% label: Maximum size of the cache in MB
+#% description: Least recently used images are removed from the cache when it is larger
+#% required: no
+#% answer: 1024
+#% options: 1-
+#%end
+#%option
+#% key: backend
+#% type: string
+#% label: Rendering backend
+#% description: Module used to create the image or in-process rendering using NumPy (by default, platform dependent)
+#% required: no
+#% options: r.out.png,d.rast,numpy
+#%end
+#%option
+#% key: warp
+#% type: string
+#% label: Reproject using a warp index with the given interpolation
+#% description: Source cells for the target region are computed by inverse projection (instead of using r.proj), the image is rendered using NumPy
+#% required: no
+#% options: nearest,bilinear
+#%end
+#%option G_OPT_F_INPUT
+#% key: batch
+#% label: File with maps to export in one run
+#% description: CSV file with a header or JSON lines with input, output and optionally epsg and flags (t, w, l, m) for each map
+#% required: no
+#% guisection: Batch
+#%end
+#%option G_OPT_F_OUTPUT
+#% key: results
+#% label: File with status and run time of each map of the batch
+#% description: CSV file written as the maps are finished
+#% required: no
+#% guisection: Batch
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% label: Number of parallel processes for the batch
+#% description: Each process uses its own temporary location for each projection
+#% required: no
+#% answer: 1
+#% options: 1-1024
+#% guisection: Batch
+#%end
+#%option G_OPT_MEMORYMB
+#% description: Maps which need more memory are rendered by blocks of rows (only for backend=numpy)
+#%end
 #%flag
 #% key: m
 #% description: Use map extent instead of current region
@@ -67,7 +136,11 @@ Created on Fri Oct  4 17:17:49 2013
 """
 
 import os
+import re
 import sys
+import csv
+import json
+import time
 
 import grass.script as gs
 from grass.script.utils import set_path
@@ -77,50 +150,258 @@ set_path(modulename='r.out.png.proj', dirname='routleaflet',
          path=os.path.join(os.path.dirname(__file__), '..'))
 
 
-from routleaflet.pngproj import export_png_in_projection
+from routleaflet.pngproj import create_sessions, start_pool, worker_sessions
+from routleaflet.cache import ExportCache
+from routleaflet.warp import SourceData
+
+
+# flags which can be set for each map of a batch
+BATCH_FLAGS = 'twlm'
+# columns of the results file
+RESULT_FIELDS = ['input', 'output', 'epsg', 'status', 'seconds', 'message']
+
+
+def parse_epsg_codes(value):
+    """Returns list of unique EPSG codes from a string or a list
+
+    Codes in a string can be separated by commas or spaces.
+    """
+    if isinstance(value, int):
+        value = [value]
+    elif not isinstance(value, list):
+        value = re.split(r'[\s,]+', str(value).strip())
+    codes = []
+    for code in value:
+        if int(code) not in codes:
+            codes.append(int(code))
+    return codes
+
+
+def target_files(output_file, epsg_codes):
+    """Returns list of EPSG codes with output files
+
+    With more codes, the files are in subdirectories named by the codes,
+    e.g. ``images/epsg3857/image.png`` (the directories are created).
+    """
+    if len(epsg_codes) == 1:
+        return [(epsg_codes[0], output_file)]
+    targets = []
+    for epsg_code in epsg_codes:
+        directory = os.path.join(os.path.dirname(output_file),
+                                 'epsg{}'.format(epsg_code))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        targets.append((epsg_code,
+                        os.path.join(directory,
+                                     os.path.basename(output_file))))
+    return targets
+
+
+def read_batch_file(filename):
+    """Read entries of the batch file as list of dictionaries
+
+    The file is either JSON lines (one object on each line) or CSV
+    with a header line. Empty lines are ignored.
+    """
+    with open(filename) as batch_file:
+        lines = [line for line in batch_file if line.strip()]
+    if lines and lines[0].lstrip().startswith('{'):
+        return [json.loads(line) for line in lines]
+    return [dict((key.strip(), (value or '').strip())
+                 for key, value in row.items() if key)
+            for row in csv.DictReader(lines)]
+
+
+def split_map_name(name, current_mapset):
+    """Returns name and mapset of a map (current mapset if not given)"""
+    # TODO: mixing current and map's mapset at this point
+    # or perhaps not an issue if parser adds mapset automatically (?)
+    if '@' in name:
+        return tuple(name.split('@', 1))
+    return name, current_mapset
+
+
+def export_job(sessions, job, settings):
+    """Export one map of a batch into all its projections
+
+    Errors are reported in the returned records, so the other maps
+    and projections are exported. With ``warp``, the map is read only
+    once for all the projections.
+
+    :param sessions: dictionary with EPSG codes as keys
+        and :class:`ProjectionSession` objects as values
+    :param job: dictionary with ``input``, ``map_name``, ``mapset``,
+        ``flags`` and ``targets`` (list of EPSG codes with output files)
+    :param settings: parameters of :meth:`ProjectionSession.export`
+        which are the same for all maps
+    :returns: list of records for the results file
+    """
+    flags = job['flags']
+    if settings.get('warp') and len(job['targets']) > 1:
+        source = SourceData(
+            memory=settings.get('memory'),
+            directory=sessions[job['targets'][0][0]].warp_directory)
+    else:
+        source = None
+    records = []
+    try:
+        for epsg_code, output_file in job['targets']:
+            start = time.time()
+            record = dict(input=job['input'], output=output_file,
+                          epsg=epsg_code, message='')
+            try:
+                cached = sessions[epsg_code].export(
+                    map_name=job['map_name'], src_mapset_name=job['mapset'],
+                    output_file=output_file,
+                    # both flags (tw) passed to r.out.png
+                    routpng_flags=''.join(flag for flag in 'tw'
+                                          if flag in flags),
+                    wgs84_file=(output_file + '.wgs84'
+                                if 'l' in flags else None),
+                    use_region='m' not in flags, source=source, **settings)
+                record['status'] = 'cached' if cached else 'exported'
+            except Exception as error:
+                record['status'] = 'failed'
+                record['message'] = str(error).strip()
+            record['seconds'] = round(time.time() - start, 3)
+            records.append(record)
+    finally:
+        if source:
+            source.close()
+    return records
+
+
+def export_job_worker(job_settings):
+    """Export one map in a worker process (see :func:`export_job`)"""
+    job, settings = job_settings
+    return export_job(worker_sessions(), job, settings)
+
+
+def export_batch(jobs, settings, nprocs, results_file=None):
+    """Export all maps of a batch reusing the temporary locations
+
+    :returns: list of records (see :func:`export_job`) in the order
+        in which the maps were finished
+    """
+    nprocs = max(1, min(nprocs, len(jobs)))
+    epsg_codes = sorted(set(epsg_code for job in jobs
+                            for epsg_code, unused in job['targets']))
+    sessions = create_sessions(nprocs, epsg_codes,
+                               warp=bool(settings.get('warp')))
+
+    # failed maps are reported in the results
+    gs.set_raise_on_error(True)
+    if nprocs > 1:
+        pool = start_pool(sessions)
+        job_records = pool.imap_unordered(export_job_worker,
+                                          [(job, settings) for job in jobs])
+    else:
+        pool = None
+        job_records = (export_job(sessions[0], job, settings)
+                       for job in jobs)
+    records = (record for records in job_records for record in records)
+
+    finished = []
+    if results_file:
+        output = open(results_file, 'w')
+        writer = csv.DictWriter(output, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+    else:
+        output = None
+    try:
+        for record in records:
+            if record['status'] == 'failed':
+                gs.warning(_("Export of <{input}> to EPSG:{epsg} failed:"
+                             " {message}").format(**record))
+            else:
+                gs.verbose(_("<{input}> exported to <{output}>"
+                             " in {seconds} s").format(**record))
+            if output:
+                writer.writerow(record)
+                # results can be watched while the batch runs
+                output.flush()
+            finished.append(record)
+    finally:
+        if output:
+            output.close()
+    if pool:
+        pool.close()
+        pool.join()
+    return finished
 
 
 def main():
     options, flags = gs.parser()
 
-    # main options
-    map_name = options['input']
-    output_file = options['output']
     # TODO: other options of g.proj are not supported
-    epsg_code = int(options['epsg'])
+    if options['epsg']:
+        epsg_codes = parse_epsg_codes(options['epsg'])
+    else:
+        epsg_codes = None
     # r.out.png options
     compression = int(options['compression'])
-    # both flags (tw) passed to r.out.png
-    routpng_flags = ''
-    if flags['t']:
-        routpng_flags += 't'
-    if flags['w']:
-        routpng_flags += 'w'
-    if flags['l']:
-        wgs84_file = output_file + '.wgs84'
+    if options['max_size']:
+        max_size = int(options['max_size'])
     else:
-        wgs84_file = None
-
-    if flags['m']:
-        use_region = False
+        max_size = None
+    if options['cache']:
+        cache = ExportCache(options['cache'],
+                            max_size=int(options['cache_size']) * 1024 ** 2)
     else:
-        use_region = True
+        cache = None
+    settings = dict(compression=compression, max_size=max_size,
+                    cache=cache, backend=options['backend'] or None,
+                    warp=options['warp'] or None,
+                    memory=int(options['memory']))
+    module_flags = ''.join(flag for flag in BATCH_FLAGS if flags[flag])
+    current_mapset = gs.gisenv()['MAPSET']
 
-    # TODO: mixing current and map's mapset at this point
-    # or perhaps not an issue if parser adds mapset automatically (?)
-    if '@' in map_name:
-        map_name, src_mapset_name = map_name.split('@')
+    if options['batch']:
+        if options['input'] or options['output']:
+            gs.fatal(_("Options input and output cannot be combined"
+                       " with the option batch"))
+        entries = read_batch_file(options['batch'])
+    elif options['input'] and options['output']:
+        entries = [dict(input=options['input'], output=options['output'])]
     else:
-        src_mapset_name = gs.gisenv()['MAPSET']
-
-    export_png_in_projection(map_name=map_name,
-                             src_mapset_name=src_mapset_name,
-                             output_file=output_file,
-                             epsg_code=epsg_code,
-                             compression=compression,
-                             routpng_flags=routpng_flags,
-                             wgs84_file=wgs84_file,
-                             use_region=use_region)
+        gs.fatal(_("Either input and output or batch must be specified"))
+
+    # each entry can have more projections
+    jobs = []
+    for number, entry in enumerate(entries, start=1):
+        if not entry.get('input') or not entry.get('output'):
+            gs.fatal(_("Entry {number} of the batch has no input"
+                       " or output").format(number=number))
+        if entry.get('epsg'):
+            entry_codes = parse_epsg_codes(entry['epsg'])
+        elif epsg_codes:
+            entry_codes = epsg_codes
+        else:
+            gs.fatal(_("EPSG code must be specified for <{}>").format(
+                entry['input']))
+        map_name, mapset = split_map_name(entry['input'], current_mapset)
+        jobs.append(dict(input=entry['input'], map_name=map_name,
+                         mapset=mapset,
+                         targets=target_files(entry['output'], entry_codes),
+                         flags=entry.get('flags') or module_flags))
+
+    records = export_batch(jobs, settings, nprocs=int(options['nprocs']),
+                           results_file=options['results'])
+    failed = [record for record in records if record['status'] == 'failed']
+    num_cached = len([record for record in records
+                      if record['status'] == 'cached'])
+    if cache:
+        # the counts from the worker processes
+        cache.report(hits=num_cached,
+                     misses=len(records) - len(failed) - num_cached)
+    if len(records) > 1:
+        gs.message(_("{num} of {total} images were exported").format(
+            num=len(records) - len(failed), total=len(records)))
+    if failed:
+        if len(records) == 1:
+            gs.fatal(failed[0]['message'])
+        return 1
+    return 0
 
 
 if __name__ == '__main__':
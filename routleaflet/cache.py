@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of exported files
+
+@author: Vaclav Petras <wenzeslaus gmail.com>
+"""
+
+import os
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+
+import grass.script as gs
+
+
+def map_fingerprint(mapset_path, map_name):
+    """Returns a string which changes when the raster map changes
+
+    Sizes and modification times of the files of the map (data, header,
+    color table, categories, null file, range) are used, so the map
+    itself is not read.
+    """
+    paths = [os.path.join(element, map_name)
+             for element in ('cell', 'fcell', 'cellhd', 'colr', 'cats')]
+    misc_path = os.path.join(mapset_path, 'cell_misc', map_name)
+    if os.path.isdir(misc_path):
+        paths.extend(os.path.join('cell_misc', map_name, name)
+                     for name in sorted(os.listdir(misc_path)))
+    stats = []
+    for path in paths:
+        try:
+            stat = os.stat(os.path.join(mapset_path, path))
+        except OSError:
+            # not all maps have all the files
+            continue
+        stats.append([path, stat.st_size, stat.st_mtime])
+    return hashlib.sha1(
+        json.dumps(stats).encode('utf-8')).hexdigest()
+
+
+class ExportCache(object):
+    """Cache of exported files stored in a directory
+
+    Each entry is a directory named by a key computed from all
+    parameters which influence the result (see :meth:`key`). An entry
+    contains one or more files, each stored under a name (role) such as
+    ``image`` or ``wgs84``.
+
+    When the total size of the cache exceeds ``max_size`` (in bytes),
+    least recently used entries are deleted. Several processes can use
+    the same cache directory at the same time.
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(**kwargs):
+        """Returns cache key for the given parameters
+
+        Values must be serializable to JSON.
+        """
+        return hashlib.sha1(
+            json.dumps(kwargs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, files):
+        """Copy files from cache entry to the given paths
+
+        :param files: dictionary with roles as keys and paths as values
+        :returns: True if the entry exists (and files were copied)
+        """
+        path = self._entry_path(key)
+        try:
+            for role, filename in files.items():
+                shutil.copyfile(os.path.join(path, role), filename)
+            # mark entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError):
+            # entry does not exist or it was evicted in the meantime
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def put(self, key, files):
+        """Store files in the cache under the given key
+
+        :param files: dictionary with roles as keys and paths as values
+        """
+        # entry is first created under a temporary name, so that
+        # other processes never see an incomplete entry
+        tmp_path = tempfile.mkdtemp(prefix='.tmp_', dir=self.directory)
+        for role, filename in files.items():
+            shutil.copyfile(filename, os.path.join(tmp_path, role))
+        try:
+            os.rename(tmp_path, self._entry_path(key))
+        except OSError as error:
+            # same entry was stored by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if error.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries to fit into the size limit"""
+        if not self.max_size:
+            return
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp_'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(path, role))
+                           for role in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                # evicted by another process
+                continue
+            total_size += size
+        for unused, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+    def report(self, hits=None, misses=None):
+        """Report cache usage
+
+        Counts from other processes can be provided as parameters.
+        """
+        if hits is None:
+            hits = self.hits
+        if misses is None:
+            misses = self.misses
+        gs.message(_("Cache <{path}>: {hits} hits, {misses} misses").format(
+            path=self.directory, hits=hits, misses=misses))
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Manifest of generated files allowing incremental updates of the output
+
+@author: Vaclav Petras <wenzeslaus gmail.com>
+"""
+
+import os
+import json
+import hashlib
+
+from routleaflet.metadata import AtomicFile
+
+
+# number of hexadecimal digits of the hash used in file names
+HASH_LENGTH = 12
+
+
+def file_hash(path):
+    """Returns SHA1 hash of the file content"""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as file_:
+        for block in iter(lambda: file_.read(1024 ** 2), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_stat(path):
+    """Returns size and modification time of the file
+
+    These are stored in the manifest, so that files which were not
+    touched do not need to be hashed again.
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def hashed_name(path, sha):
+    """Returns file name with hash inserted before the extension"""
+    base, extension = os.path.splitext(path)
+    return '{base}.{sha}{extension}'.format(base=base, sha=sha[:HASH_LENGTH],
+                                             extension=extension)
+
+
+def rename_to_hashed(directory, name):
+    """Rename file to a name with hash of its content
+
+    :param name: path relative to ``directory``
+    :returns: the new path relative to ``directory``
+    """
+    path = os.path.join(directory, name)
+    new_name = hashed_name(name, file_hash(path))
+    new_path = os.path.join(directory, new_name)
+    if os.path.exists(new_path):
+        # the same name means the same content
+        os.remove(path)
+    else:
+        os.rename(path, new_path)
+    return new_name
+
+
+def product_record(directory, key, files, attributes, immutable=None):
+    """Creates manifest record for one product of a layer
+
+    :param directory: output directory
+    :param key: key computed from all inputs of the product
+    :param files: paths of generated files relative to ``directory``
+    :param attributes: list of (name, value) pairs for the layer
+    :param immutable: files with content hash in their names
+        (their content never changes)
+    """
+    record = {'key': key,
+              'files': dict((name, file_hash(os.path.join(directory, name)))
+                            for name in files),
+              'stats': dict((name, file_stat(os.path.join(directory, name)))
+                            for name in files),
+              'attributes': [list(pair) for pair in attributes]}
+    if immutable:
+        record['immutable'] = sorted(immutable)
+    return record
+
+
+def remove_unused_files(directory, old_files, new_files):
+    """Remove files which were generated before but are not used now
+
+    This removes e.g. files with outdated content hash in their names
+    or files of layers which are not exported anymore.
+    Their precompressed copies are removed too.
+    """
+    for name in set(old_files) - set(new_files):
+        for suffix in ('', '.gz', '.br'):
+            path = os.path.join(directory, name + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def is_product_current(directory, layer, product, key):
+    """Checks if product of a layer is up-to-date
+
+    The product is up-to-date when it was generated from the same inputs
+    (the same key) and all its files exist and were not modified.
+    Only files with different size or modification time than recorded
+    are hashed, and the record is updated when their content is the same.
+
+    :param layer: layer record from the manifest (can be None)
+    """
+    if not layer:
+        return False
+    record = layer.get('products', {}).get(product)
+    if not record or record['key'] != key:
+        return False
+    stats = record.setdefault('stats', {})
+    for name, sha in record['files'].items():
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            return False
+        stat = file_stat(path)
+        if stats.get(name) == stat:
+            continue
+        if file_hash(path) != sha:
+            return False
+        stats[name] = stat
+    return True
+
+
+class Manifest(object):
+    """List of layers with their inputs and generated files
+
+    The manifest is stored as a JSON file in the output directory.
+    Each layer is a dictionary with ``title``, ``file`` and ``bounds``
+    keys and ``products`` which is a dictionary of product records
+    (see :func:`product_record`). Products made from all the layers
+    (e.g. sprite sheets) are in :attr:`products`.
+    """
+    version = 1
+
+    def __init__(self, directory, name='manifest.json'):
+        self.directory = directory
+        self.path = os.path.join(directory, name)
+        self.layers = {}
+        self.products = {}
+        if os.path.exists(self.path):
+            with open(self.path) as file_:
+                content = json.load(file_)
+            # other versions are ignored and everything is regenerated
+            if content.get('version') == self.version:
+                self.layers = content['layers']
+                self.products = content.get('products', {})
+
+    def get_layer(self, name):
+        """Returns layer record or None if there is no such layer"""
+        return self.layers.get(name)
+
+    def set_layer(self, name, layer):
+        self.layers[name] = layer
+
+    def _records(self):
+        for layer in self.layers.values():
+            for record in layer.get('products', {}).values():
+                yield record
+        for record in self.products.values():
+            yield record
+
+    def files(self):
+        """Returns set of all files of all layers and products"""
+        files = set()
+        for record in self._records():
+            files.update(record['files'])
+        return files
+
+    def immutable_files(self):
+        """Returns list of files with content hash in their names
+
+        Files shared by more layers are listed once.
+        """
+        files = set()
+        for record in self._records():
+            files.update(record.get('immutable', []))
+        return sorted(files)
+
+    def keep_only(self, names):
+        """Remove layers which are not in the list"""
+        names = set(names)
+        for name in list(self.layers.keys()):
+            if name not in names:
+                del self.layers[name]
+
+    def save(self):
+        """Write the manifest (atomically) to the output directory"""
+        with AtomicFile(self.path) as file_:
+            json.dump({'version': self.version, 'layers': self.layers,
+                       'products': self.products},
+                      file_.file, indent=1, sort_keys=True)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Layer metadata for the web page (data_file.js and per-layer JSON files)
+
+@author: Vaclav Petras <wenzeslaus gmail.com>
+"""
+
+import os
+import gzip
+import json
+import tempfile
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# directory (relative to the output directory) for per-layer JSON files
+LAYER_DATA_DIRECTORY = 'layers'
+
+
+def layer_entry(layer, opacity, attributes=None, data_file=None):
+    """Returns entry of a layer for the list of layers in data_file.js
+
+    :param layer: layer record from the manifest
+    :param opacity: opacity of the layer
+    :param attributes: additional attributes included in the entry
+        (list of name-value pairs)
+    :param data_file: path of the JSON file with the additional
+        attributes (relative to the output directory)
+    """
+    entry = OrderedDict()
+    entry['title'] = layer['title']
+    if 'max_zoom' in layer:
+        # URL template for L.tileLayer
+        entry['tiles'] = layer['file']
+        entry['minZoom'] = layer['min_zoom']
+        entry['maxZoom'] = layer['max_zoom']
+    else:
+        entry['file'] = layer['file']
+    entry['bounds'] = json.loads(layer['bounds'])
+    entry['opacity'] = opacity
+    if data_file:
+        entry['data'] = data_file
+    for name, value in attributes or []:
+        entry[name] = value
+    return entry
+
+
+def layer_data(attributes):
+    """Returns content of the JSON file with additional attributes"""
+    return json.dumps(OrderedDict(attributes), indent=1) + '\n'
+
+
+JS_HEADER = ('/* This file was generated by r.out.leaflet GRASS GIS'
+             ' module. */\n\nvar layerInfos = [\n')
+JS_FOOTER = '];\n'
+
+# permissions of new files (temporary files are private)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# files with these extensions get precompressed copies
+TEXT_EXTENSIONS = ('.js', '.json', '.csv', '.txt')
+
+
+def set_default_permissions(path):
+    """Set permissions of a temporary file as for a regular new file"""
+    os.chmod(path, 0o666 & ~_UMASK)
+
+
+def replace_file(source, destination):
+    """Rename file, replace the destination if it exists"""
+    # replace is atomic also on ms windows (rename is not)
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    else:
+        os.rename(source, destination)
+
+
+class AtomicFile(object):
+    """File which appears under its name only when it is complete
+
+    The content is written to a temporary file in the same directory
+    which is renamed when the file is closed (or discarded on error
+    when used in the ``with`` statement).
+    """
+    def __init__(self, path, mode='w'):
+        self.path = path
+        fd, self.tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix='.' + os.path.basename(path) + '_')
+        set_default_permissions(self.tmp_path)
+        self.file = os.fdopen(fd, mode)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        replace_file(self.tmp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.discard()
+        else:
+            self.close()
+
+
+def write_compressed_copies(path):
+    """Write gzip (``.gz``) and Brotli (``.br``) copies of a file
+
+    The Brotli copy is written only when the brotli package is
+    available. The gzip copy has no timestamp, so it changes only
+    when the content changes.
+    """
+    with open(path, 'rb') as source:
+        content = source.read()
+    with AtomicFile(path + '.gz', 'wb') as output:
+        gzip_file = gzip.GzipFile(filename='', mode='wb', fileobj=output.file,
+                                  compresslevel=9, mtime=0)
+        gzip_file.write(content)
+        gzip_file.close()
+    if brotli is not None:
+        with AtomicFile(path + '.br', 'wb') as output:
+            output.write(brotli.compress(content))
+
+
+def ensure_compressed_copies(path):
+    """Write compressed copies of a text file unless they are current"""
+    if not path.endswith(TEXT_EXTENSIONS):
+        return
+    copies = [path + '.gz']
+    if brotli is not None:
+        copies.append(path + '.br')
+    mtime = os.path.getmtime(path)
+    for copy in copies:
+        if not os.path.exists(copy) or os.path.getmtime(copy) < mtime:
+            write_compressed_copies(path)
+            return
+
+
+def write_text_file(path, content, compress=False):
+    """Write text file atomically (optionally with compressed copies)"""
+    with AtomicFile(path) as output:
+        output.write(content)
+    if compress:
+        write_compressed_copies(path)
+
+
+class LayerListWriter(object):
+    """Writes data_file.js and data_file.csv as the layers are finished
+
+    Layers can be added in any order (e.g. as they come from parallel
+    processes) together with their position in the list. Each layer is
+    written as soon as all the layers before it were written, so only
+    the layers which came too early are kept in memory.
+
+    When ``prepare`` function is provided, it is called with the position
+    and the entry of each layer right before the entry is written, i.e.,
+    in the order of the layers.
+
+    The files are written to temporary files and renamed when the writer
+    is closed, so a complete previous version of the files is available
+    until then. When used in the ``with`` statement, the temporary files
+    are discarded on error.
+    """
+    def __init__(self, directory, count, js_name='data_file.js',
+                 csv_name='data_file.csv', compress=False, prepare=None):
+        self.count = count
+        self.compress = compress
+        self.prepare = prepare
+        self._pending = {}
+        self._next = 0
+        self._js_file = AtomicFile(os.path.join(directory, js_name))
+        self._csv_file = AtomicFile(os.path.join(directory, csv_name))
+        self._js_file.write(JS_HEADER)
+
+    def add(self, index, entry):
+        """Add entry of a layer (see :func:`layer_entry`)
+
+        :param index: position of the layer in the list (from 0)
+        """
+        self._pending[index] = entry
+        while self._next in self._pending:
+            entry = self._pending.pop(self._next)
+            if self.prepare:
+                self.prepare(self._next, entry)
+            self._write(entry)
+            self._next += 1
+
+    def _write(self, entry):
+        if self._next:
+            self._js_file.write(',\n')
+        self._js_file.write('   ' + json.dumps(entry))
+        self._csv_file.write('{title},{file_}\n'.format(
+            title=entry['title'], file_=entry.get('file', entry.get('tiles'))))
+
+    def close(self):
+        """Finish the files and move them to their final names"""
+        if self._next != self.count:
+            self.discard()
+            raise RuntimeError("Only %d of %d layers were added"
+                               % (self._next, self.count))
+        if self.count:
+            self._js_file.write('\n')
+        self._js_file.write(JS_FOOTER)
+        for output in (self._js_file, self._csv_file):
+            output.close()
+            if self.compress:
+                write_compressed_copies(output.path)
+
+    def discard(self):
+        self._js_file.discard()
+        self._csv_file.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.discard()
+        else:
+            self.close()
@@ -6,6 +6,13 @@ Created on Tue Nov 26 12:15:37 2013
 """
 
 import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
 
 import grass.script as gs
 
@@ -13,6 +20,11 @@ import grass.script as gs
 def set_rendering_environment(width, height, filename, transparent,
                               backgroud_color='ffffff', driver='cairo',
                               compression=None, env=None):
+    """Set rendering variables in ``env`` (``os.environ`` if not set)
+
+    To keep the global environment untouched, pass a copy of the
+    environment and use it only for the rendering module.
+    """
     # if parameter not provided (but allow for empty dictionary)
     if env is None:
         env = os.environ
@@ -25,62 +37,349 @@ def set_rendering_environment(width, height, filename, transparent,
         env['GRASS_RENDER_TRANSPARENT'] = "TRUE"
     else:
         env['GRASS_RENDER_TRANSPARENT'] = "FALSE"
-    if compression:
+    if compression is not None:
         env['GRASS_RENDER_FILE_COMPRESSION'] = str(compression)
     env['GRASS_RENDER_FILE'] = str(filename)
 
 
-def export_legend(mapname, filename, width, height):
+def copy_environment(env=None):
+    """Returns copy of ``env`` (or ``os.environ``) for one subprocess"""
+    if env is None:
+        return os.environ.copy()
+    return env.copy()
+
+
+def content_box(pixels):
+    """Returns bounding box (left, upper, right, lower) of image content
+
+    For images with alpha channel, content are the pixels which are not
+    fully transparent, otherwise pixels which are not black (as for
+    PIL ``getbbox()``). Returns None for an image without any content.
+
+    :param pixels: array with shape (rows, cols) or (rows, cols, bands)
+    """
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 3 and pixels.shape[2] in (2, 4):
+        mask = pixels[..., -1] > 0
+    elif pixels.ndim == 3:
+        mask = pixels.any(axis=2)
+    else:
+        mask = pixels > 0
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not rows.size:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+
+def export_legend(mapname, filename, width, height, env=None):
+    """Render legend of a raster map and crop it to its content
+
+    The legend is rendered as an uncompressed temporary image, cropped
+    in memory and compressed only once when the final file is written.
+    """
     # using png driver but need to set bg color if we want transparency
-    # otherwise png driver will set pixels to ffffff and PIL will
-    # not crop the legend
-    set_rendering_environment(width, height, filename, transparent=True,
-                              backgroud_color='000000',
-                              driver='png')
-    gs.run_command('d.legend', raster=mapname)
+    # otherwise png driver will set pixels to ffffff and
+    # the legend will not be cropped
+    env = copy_environment(env)
+    tmp_dir = tempfile.mkdtemp()
     try:
-        from PIL import Image
-        image = Image.open(filename)
-        imageBox = image.getbbox()
-        cropped_image = image.crop(imageBox)
-        cropped_image.save(filename, 'PNG')
-    except ImportError as error:
-        gs.warning(_("Cannot crop legend image ({error})."
-                     " Maybe you don't have PIL."
-                     " Uncropped legend image will be used.") % error)
+        # no compression for the temporary image
+        tmp_file = os.path.join(tmp_dir, 'legend.png')
+        set_rendering_environment(width, height, tmp_file,
+                                  transparent=True,
+                                  backgroud_color='000000',
+                                  driver='png', compression=0, env=env)
+        gs.run_command('d.legend', raster=mapname, env=env)
+        try:
+            from PIL import Image
+        except ImportError as error:
+            gs.warning(_("Cannot crop legend image ({error})."
+                         " Maybe you don't have PIL."
+                         " Uncropped legend image will be used.") % error)
+            shutil.copyfile(tmp_file, filename)
+            return
+        image = Image.open(tmp_file)
+        image.load()
+        box = content_box(image)
+        if box:
+            image = image.crop(box)
+        image.save(filename, 'PNG')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def legend_fingerprint(mapname, width, height, env=None):
+    """Returns string which is the same for maps with the same legend
+
+    The legend depends on the color table, the range and type of
+    the map and the category labels (for integer maps), not on
+    the data, so maps of a time series usually share one legend.
+    """
+    info = gs.parse_command('r.info', map=mapname, flags='gr', env=env)
+    parts = [info['datatype'], info['min'], info['max'], width, height,
+             gs.read_command('r.colors.out', map=mapname, env=env)]
+    if info['datatype'] == 'CELL':
+        parts.append(gs.read_command('r.category', map=mapname, env=env))
+    return hashlib.sha1(
+        json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+def export_shared_legend(mapname, directory, width, height, env=None):
+    """Export legend named by its fingerprint unless it already exists
+
+    Maps with the same legend (see :func:`legend_fingerprint`) share
+    one file, so the legend is rendered only once. The file appears
+    only when it is complete, so it can be shared by parallel processes.
+
+    :returns: name of the legend file in the ``directory``
+    """
+    from routleaflet.metadata import replace_file, set_default_permissions
+
+    file_name = legend_fingerprint(mapname, width=width, height=height,
+                                   env=env) + '.png'
+    file_path = os.path.join(directory, file_name)
+    if os.path.exists(file_path):
+        return file_name
+    # the rendering needs the right file extension
+    fd, tmp_path = tempfile.mkstemp(suffix='.png', dir=directory,
+                                    prefix='.legend_')
+    os.close(fd)
+    try:
+        export_legend(mapname, tmp_path, width=width, height=height,
+                      env=env)
+        set_default_permissions(tmp_path)
+        replace_file(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return file_name
+
+
+def _text_width(draw, text):
+    if hasattr(draw, 'textbbox'):
+        box = draw.textbbox((0, 0), text)
+        return box[2] - box[0]
+    return draw.textsize(text)[0]
 
 
-def export_histogram(mapname, filename, width, height, style='bar'):
+def draw_histogram(statistics, colors, filename, width, height,
+                   style='bar'):
+    """Draw histogram from statistics computed in advance
+
+    :param statistics: :class:`routleaflet.stats.RasterStatistics`
+    :param colors: :class:`routleaflet.render.ColorTable` of the map
+        used for the bars or pie slices
+    :param style: ``bar`` or ``pie`` (as for d.histogram)
+    """
+    from PIL import Image, ImageDraw
+
+    bins = statistics.histogram()
+    image = Image.new('RGBA', (width, height), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(image)
+    black = (0, 0, 0, 255)
+    margin = min(width, height) // 10
+    counts = [count for unused, unused, count in bins]
+    if statistics.category_bins:
+        # each category is drawn as a bin from the category to the next
+        edges = [(low, low + 1) for low, unused, unused in bins]
+    else:
+        edges = [(low, high) for low, high, unused in bins]
+    if bins and max(counts):
+        centers = [[(low + high) / 2. for low, high, unused in bins]]
+        bin_colors = [tuple(int(value) for value in color)
+                      for color in colors.apply(np.array(centers))[0]]
+        if style == 'pie':
+            size = min(width, height) - 2 * margin
+            left = (width - size) // 2
+            top = (height - size) // 2
+            box = [left, top, left + size, top + size]
+            total = float(sum(counts))
+            start = -90.
+            for count, color in zip(counts, bin_colors):
+                if not count:
+                    continue
+                end = start + 360. * count / total
+                draw.pieslice(box, start, end, fill=color)
+                start = end
+            draw.ellipse(box, outline=black)
+        else:
+            left = margin
+            right = width - margin
+            top = margin
+            bottom = height - 2 * margin
+            # bars are placed by their values, so gaps between
+            # categories are visible
+            start = edges[0][0]
+            scale = (right - left) / float(edges[-1][1] - start or 1)
+            highest = float(max(counts))
+            for (low, high), count, color in zip(edges, counts, bin_colors):
+                if not count:
+                    continue
+                bar_top = bottom - (bottom - top) * count / highest
+                bar_left = left + (low - start) * scale
+                # at least one pixel wide
+                bar_right = max(left + (high - start) * scale, bar_left + 1)
+                draw.rectangle([bar_left, bar_top, bar_right, bottom],
+                               fill=color)
+            draw.line([left, top, left, bottom, right, bottom], fill=black)
+            low_label = '%g' % bins[0][0]
+            high_label = '%g' % bins[-1][1]
+            draw.text((left, bottom + 4), low_label, fill=black)
+            draw.text((right - _text_width(draw, high_label), bottom + 4),
+                      high_label, fill=black)
+            draw.text((left + 4, top), '%d' % highest, fill=black)
+    image.save(filename, 'PNG')
+
+
+def export_histogram(mapname, filename, width, height, style='bar',
+                     env=None, statistics=None):
+    """Export histogram of a raster map as an image
+
+    When ``statistics`` (see :func:`routleaflet.stats.compute_statistics`)
+    are provided, the histogram is drawn from them without reading
+    the map again, otherwise d.histogram is used.
+    """
+    if statistics is not None:
+        from routleaflet.render import ColorTable
+        colors = ColorTable.from_map(mapname, env=env)
+        draw_histogram(statistics, colors, filename, width=width,
+                       height=height, style=style)
+        return
     # using png driver to be sure that it works for ms windows
+    env = copy_environment(env)
     set_rendering_environment(width, height, filename, transparent=True,
-                              driver='png')
-    gs.run_command('d.histogram', map=mapname, style=style)
+                              driver='png', env=env)
+    gs.run_command('d.histogram', map=mapname, style=style, env=env)
+
+
+def export_histogram_data(mapname, filename, statistics, env=None):
+    """Export histogram and statistics as JSON for charts on the web page
+
+    The JSON object contains ``statistics`` (see
+    :meth:`routleaflet.stats.RasterStatistics.summary`), ``counts``
+    with the number of cells in each bin and ``colors`` with the color
+    of each bin from the color table of the map. For integer maps
+    with at most as many categories as bins, ``categories`` contains
+    the category of each bin, otherwise ``edges`` contains the edges
+    of the bins (one more than the number of bins), so the size
+    of the file is limited by the number of bins.
+    """
+    from routleaflet.render import ColorTable
+
+    bins = statistics.histogram()
+    data = {'map': mapname, 'statistics': statistics.summary(),
+            'counts': [count for unused, unused, count in bins]}
+    if statistics.category_bins:
+        data['categories'] = [low for low, unused, unused in bins]
+    elif bins:
+        data['edges'] = [low for low, unused, unused in bins] + [bins[-1][1]]
+    else:
+        data['edges'] = []
+    if bins:
+        centers = [[(low + high) / 2. for low, high, unused in bins]]
+        colors = ColorTable.from_map(mapname, env=env).apply(
+            np.array(centers))[0]
+        data['colors'] = ['#%02x%02x%02x' % tuple(color[:3])
+                          for color in colors]
+    else:
+        data['colors'] = []
+    with open(filename, 'w') as output_file:
+        json.dump(data, output_file, separators=(',', ':'))
 
 
-def export_info(mapname, filename):
-    output = gs.read_command('r.info', map=mapname)
+def export_info(mapname, filename, env=None):
+    output = gs.read_command('r.info', map=mapname, env=env)
     with open(filename, 'w') as output_file:
         output_file.write(output)
 
 
-def export_statistics(mapname, filename):
-    gs.run_command('r.univar', flags='e', map=mapname, output=filename)
+def export_statistics(mapname, filename, env=None, statistics=None):
+    """Export univariate statistics in the format of r.univar -e
 
+    When ``statistics`` are provided, they are written without
+    reading the map, otherwise r.univar is used.
+    """
+    if statistics is not None:
+        with open(filename, 'w') as output_file:
+            output_file.write(statistics.univar_text())
+        return
+    gs.run_command('r.univar', flags='e', map=mapname, output=filename,
+                   env=env)
+
+
+def thumbnail_image(input_file, output_file, size=200):
+    """Create thumbnail from an image file
+
+    Prefer :func:`routleaflet.render.render_thumbnail` which does not
+    need to read the full image.
+    """
+    from routleaflet.render import _resampling_filter
 
-def thumbnail_image(input_file, output_file):
     try:
-        import Image
+        from PIL import Image
         image = Image.open(input_file)
-        image.thumbnail((200, 200), Image.ANTIALIAS)
+        image.thumbnail((size, size), _resampling_filter())
         image.save(output_file, 'PNG')
     except ImportError as error:
         gs.warning(_("Cannot thumbnail image ({error})."
                      " Maybe you don't have PIL.") % error)
 
 
-def export_raster_as_geotiff(mapname, filename):
-    gs.run_command('r.out.tiff', input=mapname, output=filename)
+# size of internal tiles of GeoTIFF files (also the smallest overview)
+GEOTIFF_BLOCK_SIZE = 512
+
+# formats supported by r.out.gdal (found only once for each process)
+_gdal_formats = None
+
+
+def gdal_output_formats(env=None):
+    """Returns set of names of GDAL formats r.out.gdal can write"""
+    global _gdal_formats
+    if _gdal_formats is None:
+        text = gs.read_command('r.out.gdal', flags='l', env=env)
+        _gdal_formats = set(re.findall(r'^\s*(\S+) \(', text, re.MULTILINE))
+    return _gdal_formats
+
+
+def overview_levels(rows, cols, block_size=GEOTIFF_BLOCK_SIZE):
+    """Returns number of overviews needed to get to one block"""
+    levels = 0
+    size = max(rows, cols)
+    while size > block_size:
+        size = (size + 1) // 2
+        levels += 1
+    return levels
+
+
+def export_raster_as_geotiff(mapname, filename, env=None):
+    """Export raster map as cloud optimized GeoTIFF
+
+    The file is internally tiled, compressed and it contains overviews,
+    so clients can read only the parts they need using HTTP range
+    requests. The GDAL COG driver (GDAL 3.1 and later) is used when
+    available, otherwise a tiled GeoTIFF with overviews is written
+    (the overviews are not at the beginning of the file as in COG).
+    """
+    if 'COG' in gdal_output_formats(env=env):
+        gs.run_command('r.out.gdal', input=mapname, output=filename,
+                       format='COG',
+                       createopt=','.join([
+                           'COMPRESS=DEFLATE', 'PREDICTOR=YES',
+                           'BLOCKSIZE=%d' % GEOTIFF_BLOCK_SIZE,
+                           'OVERVIEWS=AUTO']),
+                       quiet=True, env=env)
+        return
+    region = gs.region(env=env)
+    levels = overview_levels(int(region['rows']), int(region['cols']))
+    gs.run_command('r.out.gdal', input=mapname, output=filename,
+                   format='GTiff',
+                   createopt=','.join([
+                       'TILED=YES', 'COMPRESS=DEFLATE',
+                       'BLOCKXSIZE=%d' % GEOTIFF_BLOCK_SIZE,
+                       'BLOCKYSIZE=%d' % GEOTIFF_BLOCK_SIZE]),
+                   overviews=levels or None, quiet=True, env=env)
 
 
-def export_raster_packed(mapname, filename):
-    gs.run_command('r.pack', input=mapname, output=filename)
+def export_raster_packed(mapname, filename, env=None):
+    gs.run_command('r.pack', input=mapname, output=filename, env=env)
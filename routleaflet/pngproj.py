@@ -7,14 +7,29 @@ Created on Thu Oct 31 22:00:39 2013
 
 import os
 import sys
+import shutil
+import atexit
 import tempfile
+import multiprocessing
+
+import numpy as np
 
 import grass.script as gs
 import grass.script.setup as gsetup
 
 from routleaflet.utils import (
     get_region, set_region, get_location_proj_string, reproject_region,
-    Mapset)
+    create_location, limit_region_size, Mapset)
+from routleaflet.cache import map_fingerprint
+from routleaflet.render import (
+    render_png, render_array, render_thumbnail, thumbnail_from_array,
+    write_world_file, ColorTable, PngWriter, DEFAULT_THUMBNAIL_SIZE,
+    RENDER_CELL_SIZE)
+from routleaflet.tiles import (
+    export_tiles, tile_grid_region, zoom_for_resolution)
+from routleaflet.transform import (
+    transform_extent, WGS84_PROJ_STRING, DEFAULT_DENSIFY)
+from routleaflet.warp import get_warp_index, SourceData
 
 
 def map_extent_to_js_leaflet_list(extent):
@@ -40,42 +55,50 @@ def get_map_extent_for_file(file_name):
             'west': wlon, 'south': slat}
 
 
-def proj_to_wgs84(region):
-    proj_in = '{east} {north}\n{west} {south}'.format(**region)
-    proc = gs.start_command('m.proj', input='-', separator=' , ',
-                            flags='od',
-                            stdin=gs.PIPE, stdout=gs.PIPE, stderr=gs.PIPE)
-    proc.stdin.write(gs.encode(proj_in))
-    proc.stdin.close()
-    proc.stdin = None
-    proj_out, errors = proc.communicate()
-    if proc.returncode:
-        raise RuntimeError("m.proj error: %s" % errors)
-    enws = gs.decode(proj_out).split(os.linesep)
-    elon, nlat, unused = enws[0].split(' ')
-    wlon, slat, unused = enws[1].split(' ')
-    return {'east': elon, 'north': nlat,
-            'west': wlon, 'south': slat}
+def proj_to_wgs84(region, proj_string=None, densify=DEFAULT_DENSIFY,
+                  env=None):
+    """Transform extent from the location projection to LL WGS84
 
+    The result is the bounding box of points sampled along the edges.
 
-def get_map_extent_for_location(map_name):
-    info_out = gs.read_command('r.info', map=map_name, flags='g')
+    :param proj_string: PROJ string of the location (obtained using
+        g.proj when not provided)
+    :param densify: number of points along each edge (None for corners)
+    """
+    if not proj_string:
+        proj_string = get_location_proj_string(env=env)
+    return transform_extent(region, from_proj=proj_string,
+                            to_proj=WGS84_PROJ_STRING, densify=densify,
+                            env=env)
+
+
+def get_map_extent_for_location(map_name, proj_string=None, env=None):
+    info_out = gs.read_command('r.info', map=map_name, flags='g', env=env)
     info = gs.parse_key_val(info_out, sep='=')
-    return proj_to_wgs84(info)
+    return proj_to_wgs84(info, proj_string=proj_string, env=env)
 
 
 def raster_to_png(map_name, output_file,
-                  compression=None, routpng_flags=None, backend=None):
+                  compression=None, routpng_flags=None, backend=None,
+                  memory=None, env=None):
     """Convert raster map ``map_name`` to PNG file named ``output_file``
 
     :param compression: PNG file compression (0-9)
     :param routpng_flags: flags for r.out.png (see r.out.png --help)
-    :param backend: ``r.out.png`` or ``d.rast``
-
-    ``backend`` can be set to ``r.out.png`` for export using this module
-    or ``d.rast`` for rendering using this module. The flags are
-    applied in both cases. Default is platform dependent and it is subject
+    :param backend: ``r.out.png``, ``d.rast`` or ``numpy``
+    :param memory: memory for the ``numpy`` backend in MB (larger maps
+        are rendered block by block)
+    :param env: environment for the modules (``os.environ`` if not set)
+
+    ``backend`` can be set to ``r.out.png`` for export using this module,
+    ``d.rast`` for rendering using this module or ``numpy`` for reading
+    the map into an array and rendering it in-process
+    (see :func:`routleaflet.render.render_png`). The flags are
+    applied in all cases. Default is platform dependent and it is subject
     to change based on the most reliable option for each platform.
+
+    Returns tuple with the data array and the RGBA array of the image
+    for the ``numpy`` backend (unless rendered by blocks), None otherwise.
     """
     if not backend:
         if sys.platform.startswith('win'):
@@ -84,10 +107,16 @@ def raster_to_png(map_name, output_file,
             backend = 'r.out.png'
     if backend == 'r.out.png':
         gs.run_command('r.out.png', input=map_name, output=output_file,
-                       compression=compression, flags=routpng_flags)
+                       compression=compression, flags=routpng_flags,
+                       env=env)
+    elif backend == 'numpy':
+        return render_png(map_name, output_file, compression=compression,
+                          routpng_flags=routpng_flags, memory=memory,
+                          env=env)
     else:
-        from routleaflet.outputs import set_rendering_environment
-        region = get_region()
+        from routleaflet.outputs import (
+            set_rendering_environment, copy_environment)
+        region = get_region(env=env)
         if region['nsres'] > region['ewres']:
             # oversample in rows, do not loose columns
             width = region['cols']
@@ -100,11 +129,13 @@ def raster_to_png(map_name, output_file,
             transparent = True
         else:
             transparent = False
+        # rendering settings are only for the d.rast subprocess
+        render_env = copy_environment(env)
         set_rendering_environment(width=width, height=height,
                                   filename=output_file,
                                   transparent=True, driver='cairo',
-                                  compression=compression)
-        gs.run_command('d.rast', map=map_name)
+                                  compression=compression, env=render_env)
+        gs.run_command('d.rast', map=map_name, env=render_env)
         if 'w' in routpng_flags:
             # TODO: the r.out.png flag -w (world file) is ignored
             gs.warning(_("World file for PNG with its actual SRS"
@@ -112,65 +143,201 @@ def raster_to_png(map_name, output_file,
                          " backend <{}>").format(backend))
 
 
-# TODO: support parallel calls, rewrite as class?
+class ProjectionSession(object):
+    """Temporary location in the target projection reused for many maps
 
+    The temporary GIS Database with a location in the projection given
+    by ``epsg_code`` is created only once when the object is created.
+    Each call of :meth:`export` then costs only the reprojection and
+    rendering. The temporary GIS Database is deleted by :meth:`cleanup`
+    which is also called when the object is used in the ``with``
+    statement.
 
-def export_png_in_projection(src_mapset_name, map_name, output_file,
-                             epsg_code,
-                             routpng_flags, compression, wgs84_file,
-                             use_region=True):
-    """
+    The session never modifies ``os.environ`` or the source GISRC file.
+    All modules in the target location are executed with a separate
+    environment, so sessions can be used from more threads in one
+    process. However, one session can be used only by one thread or
+    process at a time. For parallel processing, create one session
+    for each thread or process.
 
-    :param use_region: use computation region and not map extent
+    Warp indexes for reprojection without r.proj (see
+    :mod:`routleaflet.warp`) are stored in ``warp_directory`` which can
+    be shared by more sessions. When it is not provided, a directory
+    in the temporary GIS Database is used.
     """
-    if use_region:
-        src_region = get_region()
-        src_proj_string = get_location_proj_string()
-
-    # TODO: change only location and not gisdbase?
-    # we rely on the tmp dir having enough space for our map
-    tgt_gisdbase = tempfile.mkdtemp()
-    # this is not needed if we use mkdtemp but why not
-    tgt_location = 'r.out.png.proj_location_%s' % epsg_code
-    # because we are using PERMANENT we don't have to create mapset explicitly
-    tgt_mapset_name = 'PERMANENT'
-
-    src_mapset = Mapset(name=src_mapset_name, use_current=True)
-    assert src_mapset.exists()
-
-    # get source (old) and set target (new) GISRC enviromental variable
-    # TODO: set environ only for child processes could be enough and it would
-    # enable (?) parallel runs
-    src_gisrc = os.environ['GISRC']
-    tgt_gisrc = gsetup.write_gisrc(tgt_gisdbase,
-                                   tgt_location, tgt_mapset_name)
-    os.environ['GISRC'] = tgt_gisrc
-    # we do this only after we obtained region, so it was applied
-    # and we don't need it in the temporary (tgt) mapset
-    if os.environ.get('WIND_OVERRIDE'):
-        old_temp_region = os.environ['WIND_OVERRIDE']
-        del os.environ['WIND_OVERRIDE']
-    else:
-        old_temp_region = None
-
-    tgt_mapset = Mapset(tgt_gisdbase, tgt_location, tgt_mapset_name)
-
-    try:
-        # the function itself is not safe for other (backgroud) processes
-        # (e.g. GUI), however we already switched GISRC for us
-        # and child processes, so we don't influece others
-        gs.create_location(dbase=tgt_gisdbase,
-                           location=tgt_location,
-                           epsg=epsg_code,
-                           datum=None,
-                           datum_trans=None)
-        assert tgt_mapset.exists()
-
-        # we need to make the mapset change in the current GISRC (tgt)
-        # note that the C library for this process still holds the
-        # path to the old GISRC file (src)
-        tgt_mapset.set_as_current(gisrc=tgt_gisrc)
-
+    def __init__(self, epsg_code, env=None, warp_directory=None):
+        self.epsg_code = epsg_code
+        # TODO: change only location and not gisdbase?
+        # we rely on the tmp dir having enough space for our maps
+        self.gisdbase = tempfile.mkdtemp()
+        # this is not needed if we use mkdtemp but why not
+        self.location = 'r.out.png.proj_location_%s' % epsg_code
+        # because we are using PERMANENT we don't have to create mapset
+        # explicitly
+        self.mapset_name = 'PERMANENT'
+        self.gisrc = None
+        completed = False
+        try:
+            self.gisrc = gsetup.write_gisrc(self.gisdbase, self.location,
+                                            self.mapset_name)
+            self.mapset = Mapset(self.gisdbase, self.location,
+                                 self.mapset_name, gisrc=self.gisrc)
+
+            tgt_env = self.target_env(env)
+            create_location(location=self.location, epsg=epsg_code,
+                            env=tgt_env)
+            assert self.mapset.exists()
+            self._proj_string = get_location_proj_string(env=tgt_env)
+            completed = True
+        finally:
+            if not completed:
+                # the caller has no object to call cleanup on
+                shutil.rmtree(self.gisdbase, ignore_errors=True)
+                if self.gisrc and os.path.exists(self.gisrc):
+                    os.remove(self.gisrc)
+                self.gisdbase = None
+        self._own_warp_directory = not warp_directory
+        if warp_directory:
+            self.warp_directory = warp_directory
+        else:
+            self.warp_directory = os.path.join(self.gisdbase, 'warp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def target_env(self, env=None):
+        """Returns environment for running modules in the target location
+
+        The target environment is a copy of ``env`` (or ``os.environ``)
+        with GISRC of the target location.
+        """
+        if env is None:
+            env = os.environ
+        env = env.copy()
+        env['GISRC'] = self.gisrc
+        # the source region was already applied and we don't need it
+        # in the temporary (tgt) mapset
+        env.pop('WIND_OVERRIDE', None)
+        env.pop('GRASS_REGION', None)
+        return env
+
+    def export(self, src_mapset_name, map_name, output_file,
+               routpng_flags, compression, wgs84_file,
+               use_region=True, max_size=None, cache=None, backend=None,
+               thumbnail_file=None, thumbnail_size=DEFAULT_THUMBNAIL_SIZE,
+               warp=None, memory=None, source=None, env=None):
+        """Reproject map into the target location and export it as PNG
+
+        The reprojected map is removed from the target location
+        afterwards, so maps with the same name from different mapsets
+        can be exported in one session.
+
+        :param use_region: use computation region and not map extent
+        :param max_size: maximum width and height of the image
+        :param cache: :class:`routleaflet.cache.ExportCache` object
+            used to get the output files without reprojecting the map
+        :param backend: rendering backend (see :func:`raster_to_png`)
+        :param thumbnail_file: name of thumbnail file created from
+            the rendered image or the reprojected map
+            (see :func:`routleaflet.render.render_thumbnail`)
+        :param thumbnail_size: maximum width and height of the thumbnail
+        :param warp: interpolation method (``nearest`` or ``bilinear``)
+            for reprojection using a warp index instead of r.proj
+            (see :meth:`_export_warped`)
+        :param memory: memory for rendering in MB (see
+            :func:`raster_to_png`)
+        :param source: :class:`routleaflet.warp.SourceData` object
+            used with ``warp`` to read the map only once when it is
+            exported into more projections (created for each map
+            if not provided)
+        :param env: environment of the source location
+            (``os.environ`` if not set)
+        :returns: True if the output files were taken from the cache
+        """
+        if warp and not use_region:
+            # the map is read in its own extent
+            env = (env or os.environ).copy()
+            env['GRASS_REGION'] = gs.region_env(
+                raster='{name}@{mapset}'.format(name=map_name,
+                                                mapset=src_mapset_name),
+                env=env)
+            use_region = True
+        if use_region or cache:
+            src_region = get_region(env=env)
+            src_proj_string = get_location_proj_string(env=env)
+        else:
+            src_region = None
+            src_proj_string = None
+
+        src_mapset = Mapset(name=src_mapset_name, use_current=True, env=env)
+        assert src_mapset.exists()
+
+        if cache:
+            files = {'image': output_file}
+            if wgs84_file:
+                files['wgs84'] = wgs84_file
+            if thumbnail_file:
+                files['thumbnail'] = thumbnail_file
+            key = cache.key(
+                map='{name}@{mapset}'.format(name=map_name,
+                                             mapset=src_mapset.name),
+                fingerprint=map_fingerprint(src_mapset.mapset_path,
+                                            map_name),
+                region=[src_region[name] for name in
+                        ('north', 'south', 'east', 'west', 'rows', 'cols')],
+                proj=src_proj_string, epsg=self.epsg_code,
+                flags=routpng_flags, compression=compression,
+                use_region=use_region, max_size=max_size,
+                backend=backend, files=sorted(files),
+                thumbnail_size=thumbnail_size if thumbnail_file else None,
+                warp=warp)
+            if cache.get(key, files):
+                return True
+
+        if warp:
+            self._export_warped(src_mapset, map_name, output_file,
+                                routpng_flags, compression, wgs84_file,
+                                src_region=src_region,
+                                src_proj_string=src_proj_string,
+                                max_size=max_size, method=warp,
+                                thumbnail_file=thumbnail_file,
+                                thumbnail_size=thumbnail_size,
+                                memory=memory, source=source, env=env)
+            if cache:
+                cache.put(key, files)
+            return False
+        tgt_env = self.target_env(env)
+        try:
+            self._export(src_mapset, map_name, output_file,
+                         routpng_flags, compression, wgs84_file,
+                         use_region=use_region,
+                         src_region=src_region,
+                         src_proj_string=src_proj_string,
+                         max_size=max_size, backend=backend,
+                         thumbnail_file=thumbnail_file,
+                         thumbnail_size=thumbnail_size,
+                         memory=memory, env=tgt_env)
+        finally:
+            # the map is not needed anymore and the next map
+            # may have the same name
+            gs.run_command('g.remove', type='raster', name=map_name,
+                           flags='f', quiet=True, env=tgt_env)
+        if cache:
+            cache.put(key, files)
+        return False
+
+    def _import_map(self, src_mapset, map_name, use_region, src_region,
+                    src_proj_string, max_size, env, max_zoom=None,
+                    tiles=False):
+        """Set the target region and reproject the map into it
+
+        With ``tiles``, the region is aligned with the tiles of the zoom
+        level which corresponds to the resolution (limited by
+        ``max_zoom``). Returns the zoom level for tiles, otherwise None.
+        """
         # setting region
         if use_region:
             # respecting computation region of the src location
@@ -178,15 +345,11 @@ def export_png_in_projection(src_mapset_name, map_name, output_file,
             # and m.proj and g.region now
             # respecting MASK of the src location would be hard
             # null values in map are usually enough
-            tgt_proj_string = get_location_proj_string()
+            # the resolution is derived from the src region
             tgt_region = reproject_region(src_region,
                                           from_proj=src_proj_string,
-                                          to_proj=tgt_proj_string)
-            # uses g.region thus and sets region only for child processes
-            # which is enough now
-            # TODO: unlike the other branch, this keeps the current
-            # resolution which is not correct
-            set_region(tgt_region)
+                                          to_proj=self._proj_string,
+                                          env=env)
         else:
             # find out map extent to import everything
             # using only classic API because of some problems with pygrass
@@ -195,20 +358,56 @@ def export_png_in_projection(src_mapset_name, map_name, output_file,
                                         dbase=src_mapset.database,
                                         location=src_mapset.location,
                                         mapset=src_mapset.name,
-                                        output=map_name, flags='g')
+                                        output=map_name, flags='g',
+                                        env=env)
             a = gs.parse_key_val(rproj_out, sep='=', vsep=' ')
-            gs.run_command('g.region', **a)
+            tgt_region = {'north': float(a['n']), 'south': float(a['s']),
+                          'east': float(a['e']), 'west': float(a['w']),
+                          'rows': int(a['rows']), 'cols': int(a['cols'])}
+        zoom = None
+        if tiles:
+            resolution = ((float(tgt_region['east']) -
+                           float(tgt_region['west'])) /
+                          int(tgt_region['cols']))
+            zoom = zoom_for_resolution(resolution)
+            if max_zoom is not None:
+                zoom = min(zoom, max_zoom)
+            tgt_region = tile_grid_region(tgt_region, zoom)
+        elif max_size:
+            tgt_region = limit_region_size(tgt_region, max_size)
+        # uses g.region thus and sets region only for the target
+        # mapset which is not used by anybody else
+        set_region(tgt_region, env=env)
 
         # map import
         gs.message("Reprojecting...")
         gs.run_command('r.proj', input=map_name, dbase=src_mapset.database,
                        location=src_mapset.location, mapset=src_mapset.name,
-                       output=map_name, quiet=True)
+                       output=map_name, quiet=True, env=env)
+        return zoom
+
+    def _export(self, src_mapset, map_name, output_file,
+                routpng_flags, compression, wgs84_file,
+                use_region, src_region, src_proj_string, max_size,
+                backend, env, thumbnail_file=None,
+                thumbnail_size=DEFAULT_THUMBNAIL_SIZE, memory=None):
+        self._import_map(src_mapset, map_name, use_region=use_region,
+                         src_region=src_region,
+                         src_proj_string=src_proj_string,
+                         max_size=max_size, env=env)
 
         # actual export
         gs.message("Rendering...")
-        raster_to_png(map_name, output_file, compression=compression,
-                      routpng_flags=routpng_flags)
+        rendered = raster_to_png(map_name, output_file,
+                                 compression=compression,
+                                 routpng_flags=routpng_flags,
+                                 backend=backend, memory=memory,
+                                 env=env)
+        if thumbnail_file:
+            # the image in memory or the map at low resolution is used
+            render_thumbnail(map_name, thumbnail_file, size=thumbnail_size,
+                             rgba=rendered[1] if rendered else None,
+                             routpng_flags=routpng_flags, env=env)
 
         # outputting file with WGS84 coordinates
         if wgs84_file:
@@ -221,32 +420,317 @@ def export_png_in_projection(src_mapset_name, map_name, output_file,
                     # hopefully this is consistent with r.out.png behavior
                     data_file.write(
                         map_extent_to_file_content(
-                            proj_to_wgs84(get_region())) + '\n')
+                            proj_to_wgs84(get_region(env=env),
+                                          proj_string=self._proj_string,
+                                          env=env)) + '\n')
                 else:
                     # use map to get extent
                     # the result is actually the same as using map
                     # if region is the same as map (use_region == False)
                     data_file.write(
                         map_extent_to_file_content(
-                            get_map_extent_for_location(map_name)) +
+                            get_map_extent_for_location(
+                                map_name, proj_string=self._proj_string,
+                                env=env)) +
                         '\n')
 
-    finally:
-        # juts in case we need to do something in the old location
-        # our callers probably do
-        os.environ['GISRC'] = src_gisrc
-        if old_temp_region:
-            os.environ['WIND_OVERRIDE'] = old_temp_region
-        # set current in library
-        src_mapset.set_as_current(gisrc=src_gisrc)
-
+    def _export_warped(self, src_mapset, map_name, output_file,
+                       routpng_flags, compression, wgs84_file,
+                       src_region, src_proj_string, max_size, method, env,
+                       thumbnail_file=None,
+                       thumbnail_size=DEFAULT_THUMBNAIL_SIZE, memory=None,
+                       source=None):
+        """Reproject map using a warp index and render it using NumPy
+
+        The target region is the same as for r.proj. The warp index
+        for the source and target region is computed only once, so all
+        maps with the same region (e.g. in a time series) cost only
+        reading the map and one gather (see
+        :class:`routleaflet.warp.WarpIndex`). The map is not imported
+        into the target location. The ``env`` is for the source location.
+
+        Like r.proj, the map is read in its own resolution (the extent
+        of ``src_region`` aligned to the cells of the map), so the warp
+        index is for the cells of the map and not of the region.
+
+        When the rendering needs more than ``memory`` (in MB), the image
+        is gathered and written by blocks of rows (see
+        :class:`routleaflet.render.PngWriter`) and the source data
+        larger than ``memory`` are memory mapped from a temporary file
+        (see :class:`routleaflet.warp.SourceData`). When ``source`` is
+        provided, the data already read by it are used.
+        """
+        tgt_region = reproject_region(src_region, from_proj=src_proj_string,
+                                      to_proj=self._proj_string, env=env)
+        if max_size:
+            tgt_region = limit_region_size(tgt_region, max_size)
+        full_name = '{name}@{mapset}'.format(name=map_name,
+                                             mapset=src_mapset.name)
+        # the region is already in env, only the cells are of the map
+        read_env = (env or os.environ).copy()
+        read_env['GRASS_REGION'] = gs.region_env(align=full_name, env=env)
+        map_region = get_region(env=read_env)
+        if not os.path.exists(self.warp_directory):
+            os.makedirs(self.warp_directory)
+        index = get_warp_index(self.warp_directory, map_region,
+                               src_proj=src_proj_string,
+                               tgt_region=tgt_region,
+                               tgt_proj=self._proj_string, method=method,
+                               env=env)
+        colors = ColorTable.from_map(full_name, env=env)
+        rows, cols = index.shape
+        if memory:
+            block_rows = max(1, int(memory * 1024 ** 2) //
+                             (RENDER_CELL_SIZE * cols))
+        else:
+            block_rows = rows
+        own_source = source is None
+        if own_source:
+            source = SourceData(memory=memory,
+                                directory=self.warp_directory)
+        try:
+            data = source.get(full_name, map_region, env=read_env)
+            if block_rows >= rows:
+                gs.message("Reprojecting...")
+                target = index.apply(data)
+                gs.message("Rendering...")
+                rgba = render_array(target, colors, output_file,
+                                    region=tgt_region,
+                                    compression=compression,
+                                    routpng_flags=routpng_flags)
+                if thumbnail_file:
+                    thumbnail_from_array(rgba, thumbnail_file,
+                                         size=thumbnail_size)
+            else:
+                gs.message("Reprojecting and rendering by blocks...")
+                self._render_warped_blocks(
+                    index, data, colors, output_file, tgt_region,
+                    block_rows=block_rows, compression=compression,
+                    routpng_flags=routpng_flags,
+                    thumbnail_file=thumbnail_file,
+                    thumbnail_size=thumbnail_size)
+        finally:
+            if own_source:
+                source.close()
+        if wgs84_file:
+            gs.verbose("Projecting coordinates to LL WGS 84...")
+            with open(wgs84_file, 'w') as data_file:
+                data_file.write(
+                    map_extent_to_file_content(
+                        proj_to_wgs84(tgt_region,
+                                      proj_string=self._proj_string,
+                                      env=env)) + '\n')
+
+    @staticmethod
+    def _render_warped_blocks(index, data, colors, output_file, region,
+                              block_rows, compression, routpng_flags,
+                              thumbnail_file=None,
+                              thumbnail_size=DEFAULT_THUMBNAIL_SIZE):
+        """Gather and write the image by blocks of rows
+
+        The thumbnail is made from the cells sampled at twice
+        the thumbnail size, so the whole image is never in memory.
+        """
+        routpng_flags = routpng_flags or ''
+        transparent = 't' in routpng_flags
+        rows, cols = index.shape
+        with PngWriter(output_file, width=cols, height=rows,
+                       transparent=transparent,
+                       compression=compression) as writer:
+            for start in range(0, rows, block_rows):
+                block = index.apply(
+                    data, rows=slice(start, min(start + block_rows, rows)))
+                writer.write(colors.apply(block, transparent=transparent))
+        if 'w' in routpng_flags:
+            write_world_file(output_file, region)
+        if thumbnail_file:
+            scale = min(1., 2. * thumbnail_size / max(rows, cols))
+
+            def sample(count):
+                size = max(1, int(round(count * scale)))
+                return ((np.arange(size) + 0.5) * count / size).astype(int)
+            block = index.apply(data, rows=sample(rows), cols=sample(cols))
+            thumbnail_from_array(colors.apply(block, transparent=transparent),
+                                 thumbnail_file, size=thumbnail_size)
+
+    def export_tiles(self, src_mapset_name, map_name, output_directory,
+                     routpng_flags, compression, use_region=True,
+                     min_zoom=0, max_zoom=None, nprocs=1, backend=None,
+                     env=None):
+        """Reproject map into the target location and export it as tiles
+
+        The target location must be in EPSG:3857. The tiles are written
+        to ``output_directory`` as ``{z}/{x}/{y}.png``
+        (see :func:`routleaflet.tiles.export_tiles`).
+
+        :param min_zoom: the lowest zoom level to create
+        :param max_zoom: the highest zoom level to create (by default,
+            it is derived from the resolution)
+        :param nprocs: number of threads used for rendering
+        :param backend: rendering backend (see :func:`raster_to_png`)
+        :param env: environment of the source location
+            (``os.environ`` if not set)
+        :returns: dictionary with ``min_zoom``, ``max_zoom``,
+            ``tiles`` (tiles for each zoom level) and ``extent``
+            (LL WGS84 extent of the tiles)
+        """
+        if int(self.epsg_code) != 3857:
+            raise ValueError(_("Tiles can be created only for EPSG:3857,"
+                               " not for EPSG:{}").format(self.epsg_code))
+        src_region = get_region(env=env)
+        src_proj_string = get_location_proj_string(env=env)
+        src_mapset = Mapset(name=src_mapset_name, use_current=True, env=env)
+        assert src_mapset.exists()
+
+        tgt_env = self.target_env(env)
+        try:
+            zoom = self._import_map(src_mapset, map_name,
+                                    use_region=use_region,
+                                    src_region=src_region,
+                                    src_proj_string=src_proj_string,
+                                    max_size=None, env=tgt_env,
+                                    max_zoom=max_zoom, tiles=True)
+            min_zoom = min(min_zoom, zoom)
+            gs.message("Rendering tiles...")
+            tiles = export_tiles(map_name, output_directory, zoom=zoom,
+                                 min_zoom=min_zoom,
+                                 compression=compression,
+                                 routpng_flags=routpng_flags,
+                                 nprocs=nprocs, backend=backend,
+                                 env=tgt_env)
+            extent = proj_to_wgs84(get_region(env=tgt_env),
+                                   proj_string=self._proj_string,
+                                   env=tgt_env)
+        finally:
+            gs.run_command('g.remove', type='raster', name=map_name,
+                           flags='f', quiet=True, env=tgt_env)
+        return dict(min_zoom=min_zoom, max_zoom=zoom, tiles=tiles,
+                    extent=extent)
+
+    def cleanup(self):
+        """Delete the temporary GIS Database
+
+        It is safe to call this function more than once.
+        """
+        if not self.gisdbase:
+            return
+        if self._own_warp_directory and os.path.exists(self.warp_directory):
+            shutil.rmtree(self.warp_directory)
         # delete the whole gisdbase
         # delete file by file to ensure that we are deleting only our things
         # exception will be raised when removing non-empty directory
-        tgt_mapset.delete()
-        os.rmdir(tgt_mapset.location_path)
+        if self.mapset.exists():
+            self.mapset.delete()
+        if os.path.exists(self.mapset.location_path):
+            os.rmdir(self.mapset.location_path)
         # dir created by tempfile.mkdtemp() needs to be romved manually
-        os.rmdir(tgt_gisdbase)
+        os.rmdir(self.gisdbase)
         # we have to remove file created by tempfile.mkstemp function
         # in write_gisrc function
-        os.remove(tgt_gisrc)
+        os.remove(self.gisrc)
+        self.gisdbase = None
+
+
+def create_sessions(nprocs, epsg_codes, warp=False):
+    """Create projection sessions for each process and EPSG code
+
+    The temporary locations are created only once for all maps,
+    each process needs its own. With ``warp``, the warp indexes are
+    stored in one temporary directory shared by all the sessions,
+    so each index is computed only once. The sessions and the directory
+    are removed at exit.
+
+    :returns: list with a dictionary for each process with EPSG codes
+        as keys and :class:`ProjectionSession` objects as values
+    """
+    if warp:
+        warp_directory = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, warp_directory, True)
+    else:
+        warp_directory = None
+    sessions = []
+    for unused in range(nprocs):
+        process_sessions = {}
+        for epsg_code in epsg_codes:
+            session = ProjectionSession(epsg_code,
+                                        warp_directory=warp_directory)
+            atexit.register(session.cleanup)
+            process_sessions[epsg_code] = session
+        sessions.append(process_sessions)
+    return sessions
+
+
+# projection sessions of the worker process (set by init_worker)
+_worker_sessions = None
+
+
+def init_worker(sessions):
+    """Initialize worker process with one of the prepared sessions
+
+    Errors of modules are raised as exceptions, so they can be reported
+    by the main process instead of ending the worker.
+
+    :param sessions: queue with dictionaries from :func:`create_sessions`
+    """
+    global _worker_sessions
+    gs.set_raise_on_error(True)
+    _worker_sessions = sessions.get()
+
+
+def worker_sessions():
+    """Returns sessions of the current worker process
+
+    See :func:`start_pool`.
+    """
+    return _worker_sessions
+
+
+def start_pool(sessions):
+    """Start pool with a process for each item of ``sessions``
+
+    The sessions for each process (from :func:`create_sessions`) are
+    available in the process using :func:`worker_sessions`.
+    """
+    session_queue = multiprocessing.Queue()
+    for process_sessions in sessions:
+        session_queue.put(process_sessions)
+    return multiprocessing.Pool(len(sessions), init_worker, (session_queue,))
+
+
+def export_png_in_projection(src_mapset_name, map_name, output_file,
+                             epsg_code,
+                             routpng_flags, compression, wgs84_file,
+                             use_region=True, max_size=None, cache=None,
+                             backend=None, warp=None, memory=None,
+                             env=None):
+    """Export one map to PNG in the projection given by EPSG code
+
+    When exporting more maps to the same projection, use
+    :class:`ProjectionSession` directly to create the temporary location
+    only once.
+
+    :param use_region: use computation region and not map extent
+    :param max_size: maximum width and height of the image
+    :param cache: :class:`routleaflet.cache.ExportCache` object
+    :param backend: rendering backend (see :func:`raster_to_png`)
+    :param warp: interpolation method for reprojection using a warp
+        index (see :meth:`ProjectionSession.export`)
+    :param memory: memory for rendering in MB (see :func:`raster_to_png`)
+    :param env: environment of the source location
+        (``os.environ`` if not set)
+    :returns: True if the output files were taken from the cache
+    """
+    with ProjectionSession(epsg_code, env=env) as session:
+        return session.export(src_mapset_name=src_mapset_name,
+                              map_name=map_name,
+                              output_file=output_file,
+                              routpng_flags=routpng_flags,
+                              compression=compression,
+                              wgs84_file=wgs84_file,
+                              use_region=use_region,
+                              max_size=max_size,
+                              cache=cache,
+                              backend=backend,
+                              warp=warp,
+                              memory=memory,
+                              env=env)
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of raster maps to images in-process using NumPy
+
+The raster map is read by r.out.bin, colors are assigned from the color
+table of the map (as printed by r.colors.out) and the image is written
+using PIL. The data and the colored image stay available as arrays,
+so other outputs can be created without reading the map again.
+
+Maps which do not fit into the given memory are rendered block by block
+and the rows are written to the PNG file as they come (see
+:class:`PngWriter`), so the memory use does not depend on the size
+of the map.
+
+@author: Vaclav Petras <wenzeslaus gmail.com>
+"""
+
+import os
+import zlib
+import struct
+
+import numpy as np
+
+import grass.script as gs
+
+from routleaflet.utils import get_region, region_env_string, limit_region_size
+
+
+# size of a block of rows read at once (in bytes of the data)
+DEFAULT_BLOCK_SIZE = 16 * 1024 ** 2
+# maximum width and height of thumbnails
+DEFAULT_THUMBNAIL_SIZE = 200
+# memory needed for rendering one cell in bytes (data, colors,
+# and temporary arrays)
+RENDER_CELL_SIZE = 48
+
+
+def _read_exactly(stream, size):
+    """Read exactly ``size`` bytes from a stream (pipe)"""
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_raster_blocks(map_name, block_rows=None, env=None):
+    """Read raster map in the current region block by block
+
+    Yields blocks of rows as 2D float64 arrays with NaN for NULL
+    cells. The whole map is never held in memory.
+
+    :param block_rows: number of rows in one block (by default derived
+        from :data:`DEFAULT_BLOCK_SIZE`)
+    """
+    region = get_region(env=env)
+    rows = int(region['rows'])
+    cols = int(region['cols'])
+    if not block_rows:
+        block_rows = max(1, DEFAULT_BLOCK_SIZE // (8 * cols))
+    row_size = 8 * cols
+    proc = gs.start_command('r.out.bin', flags='f', input=map_name,
+                            output='-', bytes=8, null='nan', quiet=True,
+                            stdout=gs.PIPE, env=env)
+    completed = False
+    try:
+        for start in range(0, rows, block_rows):
+            count = min(block_rows, rows - start)
+            data = _read_exactly(proc.stdout, count * row_size)
+            if len(data) != count * row_size:
+                break
+            yield np.frombuffer(data, dtype=np.float64).reshape(count, cols)
+        else:
+            completed = True
+    finally:
+        if not completed:
+            # reading stopped early (error or closed generator)
+            proc.kill()
+        proc.stdout.close()
+        returncode = proc.wait()
+    if not completed or returncode:
+        raise RuntimeError("r.out.bin failed to read raster map <%s>"
+                           % map_name)
+
+
+def read_raster(map_name, env=None):
+    """Read raster map in the current region into a 2D float64 array
+
+    NULL cells are NaN.
+    """
+    blocks = list(read_raster_blocks(map_name, env=env))
+    if not blocks:
+        region = get_region(env=env)
+        return np.empty((0, int(region['cols'])))
+    return np.vstack(blocks)
+
+
+def _parse_color(text):
+    return [int(value) for value in text.split(':')[:3]]
+
+
+class ColorTable(object):
+    """Color table of a raster map which can be applied to arrays
+
+    The colors between the rule values are linearly interpolated,
+    values outside of the rules get the default color and NULL cells
+    get the null color (or they are transparent).
+    """
+    def __init__(self, values, colors, null_color=None, default_color=None):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+        self.null_color = null_color or [255, 255, 255]
+        self.default_color = default_color or [255, 255, 255]
+
+    @classmethod
+    def parse(cls, text):
+        """Create color table from rules as printed by r.colors.out"""
+        values = []
+        colors = []
+        null_color = None
+        default_color = None
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            value, color = line.split()[:2]
+            if value == 'nv':
+                null_color = _parse_color(color)
+            elif value == 'default':
+                default_color = _parse_color(color)
+            else:
+                values.append(float(value))
+                colors.append(_parse_color(color))
+        return cls(values, colors, null_color=null_color,
+                   default_color=default_color)
+
+    @classmethod
+    def from_map(cls, map_name, env=None):
+        """Read color table of a raster map"""
+        return cls.parse(gs.read_command('r.colors.out', map=map_name,
+                                         env=env))
+
+    def apply(self, data, transparent=False):
+        """Assign colors to values
+
+        :param data: 2D array with NaN for NULL cells
+        :param transparent: make NULL cells transparent
+        :returns: RGBA array of unsigned bytes (rows, cols, 4)
+        """
+        null = np.isnan(data)
+        rgba = np.empty(data.shape + (4,), dtype=np.uint8)
+        rgba[..., 3] = 255
+        if self.values.size:
+            filled = np.where(null, self.values[0], data)
+            for band in range(3):
+                rgba[..., band] = np.rint(
+                    np.interp(filled, self.values, self.colors[:, band]))
+            outside = (filled < self.values[0]) | (filled > self.values[-1])
+            rgba[outside, :3] = self.default_color
+        else:
+            rgba[..., :3] = self.default_color
+        rgba[null, :3] = self.null_color
+        if transparent:
+            rgba[null, 3] = 0
+        return rgba
+
+
+def world_file_path(output_file):
+    """Returns name of the world file for an image (as r.out.png)"""
+    base, extension = os.path.splitext(output_file)
+    if extension.lower() != '.png':
+        base = output_file
+    return base + '.wld'
+
+
+def write_world_file(output_file, region):
+    """Write world file for an image covering the region"""
+    ewres = ((float(region['east']) - float(region['west']))
+             / int(region['cols']))
+    nsres = ((float(region['north']) - float(region['south']))
+             / int(region['rows']))
+    with open(world_file_path(output_file), 'w') as world_file:
+        world_file.write('\n'.join(repr(value) for value in [
+            ewres, 0.0, 0.0, -nsres,
+            float(region['west']) + ewres / 2.,
+            float(region['north']) - nsres / 2.]) + '\n')
+
+
+def write_png(rgba, output_file, compression=None, transparent=True):
+    """Write RGBA array as PNG (RGB when not ``transparent``)"""
+    from PIL import Image
+
+    if compression is None:
+        compression = 6
+    image = Image.fromarray(rgba, 'RGBA')
+    if not transparent:
+        image = image.convert('RGB')
+    image.save(output_file, 'PNG', compress_level=compression)
+
+
+class PngWriter(object):
+    """PNG image written block of rows by block of rows
+
+    The rows are filtered (using the PNG filter Up) and compressed
+    as they are written, so only the compressed data which were not
+    written yet and the last row are kept in memory.
+    """
+    signature = b'\x89PNG\r\n\x1a\n'
+
+    def __init__(self, output_file, width, height, transparent=True,
+                 compression=None):
+        if compression is None:
+            compression = 6
+        self.width = width
+        self.height = height
+        self.channels = 4 if transparent else 3
+        self.rows = 0
+        self._previous = np.zeros(width * self.channels, dtype=np.uint8)
+        self._compressor = zlib.compressobj(compression)
+        self._file = open(output_file, 'wb')
+        self._file.write(self.signature)
+        # 8 bits per sample, truecolor with or without alpha
+        self._chunk(b'IHDR', struct.pack(
+            '>IIBBBBB', width, height, 8, 6 if transparent else 2, 0, 0, 0))
+
+    def _chunk(self, chunk_type, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack(
+            '>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def write(self, rgba):
+        """Write block of rows given as RGBA array (rows, width, 4)"""
+        rows = rgba.shape[0]
+        if self.rows + rows > self.height:
+            raise ValueError("More rows than the image height %d"
+                             % self.height)
+        pixels = rgba[..., :self.channels].reshape(rows, -1)
+        filtered = np.empty((rows, pixels.shape[1] + 1), dtype=np.uint8)
+        # filter type Up (difference from the previous row)
+        filtered[:, 0] = 2
+        filtered[0, 1:] = pixels[0] - self._previous
+        filtered[1:, 1:] = pixels[1:] - pixels[:-1]
+        self._previous = pixels[-1].copy()
+        self.rows += rows
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+
+    def close(self):
+        """Finish the file (all rows must be written)"""
+        try:
+            if self.rows != self.height:
+                raise ValueError("Only %d of %d rows were written"
+                                 % (self.rows, self.height))
+            self._chunk(b'IDAT', self._compressor.flush())
+            self._chunk(b'IEND', b'')
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self._file.close()
+        else:
+            self.close()
+
+
+def render_png_blocks(map_name, output_file, compression=None,
+                      routpng_flags=None, memory=None, env=None):
+    """Render raster map block by block with limited memory
+
+    The map is read by blocks of rows (see :func:`read_raster_blocks`),
+    the colors are applied to each block and it is written to the PNG
+    file right away (see :class:`PngWriter`).
+
+    :param memory: memory for the rendering in MB (determines the
+        number of rows in one block)
+    """
+    routpng_flags = routpng_flags or ''
+    transparent = 't' in routpng_flags
+    region = get_region(env=env)
+    rows = int(region['rows'])
+    cols = int(region['cols'])
+    if memory:
+        block_rows = max(1, int(memory * 1024 ** 2) //
+                         (RENDER_CELL_SIZE * cols))
+    else:
+        block_rows = None
+    colors = ColorTable.from_map(map_name, env=env)
+    with PngWriter(output_file, width=cols, height=rows,
+                   transparent=transparent,
+                   compression=compression) as writer:
+        for block in read_raster_blocks(map_name, block_rows=block_rows,
+                                        env=env):
+            writer.write(colors.apply(block, transparent=transparent))
+    if 'w' in routpng_flags:
+        write_world_file(output_file, region)
+
+
+def render_png(map_name, output_file, compression=None, routpng_flags=None,
+               memory=None, env=None):
+    """Render raster map in the current region to PNG in-process
+
+    The flags have the same meaning as for r.out.png (``t`` for
+    transparent NULL cells and ``w`` for world file).
+
+    When rendering of the whole map needs more than ``memory`` (in MB),
+    it is rendered block by block (see :func:`render_png_blocks`).
+
+    :returns: tuple with the data array (NaN for NULL cells) and
+        the RGBA array of the image, None when rendered by blocks
+    """
+    if memory:
+        region = get_region(env=env)
+        size = int(region['rows']) * int(region['cols']) * RENDER_CELL_SIZE
+        if size > memory * 1024 ** 2:
+            render_png_blocks(map_name, output_file,
+                              compression=compression,
+                              routpng_flags=routpng_flags, memory=memory,
+                              env=env)
+            return None
+    data = read_raster(map_name, env=env)
+    colors = ColorTable.from_map(map_name, env=env)
+    rgba = render_array(data, colors, output_file, compression=compression,
+                        routpng_flags=routpng_flags,
+                        region=get_region(env=env))
+    return data, rgba
+
+
+def render_array(data, colors, output_file, region, compression=None,
+                 routpng_flags=None):
+    """Render data array covering the region to PNG
+
+    :param colors: :class:`ColorTable` of the map
+    :param routpng_flags: flags as for :func:`render_png`
+    :returns: the RGBA array of the image
+    """
+    routpng_flags = routpng_flags or ''
+    transparent = 't' in routpng_flags
+    rgba = colors.apply(data, transparent=transparent)
+    write_png(rgba, output_file, compression=compression,
+              transparent=transparent)
+    if 'w' in routpng_flags:
+        write_world_file(output_file, region)
+    return rgba
+
+
+def _resampling_filter():
+    from PIL import Image
+
+    # ANTIALIAS is the old name (removed in Pillow 10)
+    return getattr(Image, 'LANCZOS', getattr(Image, 'ANTIALIAS', None))
+
+
+def thumbnail_from_array(rgba, output_file, size=DEFAULT_THUMBNAIL_SIZE):
+    """Write thumbnail of an image given as RGBA array"""
+    from PIL import Image
+
+    image = Image.fromarray(rgba, 'RGBA')
+    image.thumbnail((size, size), _resampling_filter())
+    image.save(output_file, 'PNG')
+
+
+def render_thumbnail(map_name, output_file, size=DEFAULT_THUMBNAIL_SIZE,
+                     rgba=None, routpng_flags=None, env=None):
+    """Create thumbnail of a raster map in the current region
+
+    When the RGBA array of the rendered map is provided (see
+    :func:`render_png`), it is downsampled. Otherwise, the map is read
+    with the resolution of the thumbnail (using GRASS_REGION in a copy
+    of the environment), so no full-size image needs to be read.
+    """
+    if rgba is not None:
+        thumbnail_from_array(rgba, output_file, size=size)
+        return
+    if env is None:
+        env = os.environ
+    region = limit_region_size(get_region(env=env), size)
+    env = env.copy()
+    env['GRASS_REGION'] = region_env_string(gs.region_env(env=env), region)
+    # the world file is not needed for thumbnail
+    render_png(map_name, output_file,
+               routpng_flags=(routpng_flags or '').replace('w', ''),
+               env=env)
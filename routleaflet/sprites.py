@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Packing of small images (legends, thumbnails) into sprite sheets
+
+@author: Vaclav Petras <wenzeslaus gmail.com>
+"""
+
+import os
+
+from routleaflet.metadata import AtomicFile
+from routleaflet.manifest import rename_to_hashed
+
+
+# maximum width and height of one sprite sheet
+DEFAULT_SHEET_SIZE = 2048
+# space between images (avoids bleeding when scaled by the browser)
+PADDING = 1
+
+
+class SpriteSheets(object):
+    """Images packed into one or more sprite sheets
+
+    Images are placed as they are added (online) into rows (shelves)
+    of a sheet. When an image does not fit into the current sheet,
+    a new sheet is started. The same image added more times is placed
+    only once.
+
+    The sheets are written by :meth:`save` as
+    ``{name}-{number}.png`` in ``directory`` (optionally with hash
+    of the content in the name).
+    """
+    def __init__(self, directory, name, sheet_size=DEFAULT_SHEET_SIZE,
+                 compression=None):
+        self.directory = directory
+        self.name = name
+        self.sheet_size = sheet_size
+        self.compression = compression
+        self._sheets = []
+        # used width and height of each sheet
+        self._extents = []
+        self._placed = {}
+        self._shelf_x = 0
+        self._shelf_y = 0
+        self._shelf_height = 0
+
+    def _sheet_file(self, number):
+        return '{name}-{number}.png'.format(name=self.name, number=number)
+
+    def _new_sheet(self):
+        from PIL import Image
+
+        self._sheets.append(
+            Image.new('RGBA', (self.sheet_size, self.sheet_size)))
+        self._extents.append([0, 0])
+        self._shelf_x = 0
+        self._shelf_y = 0
+        self._shelf_height = 0
+
+    def _place(self, width, height):
+        """Returns position for an image of the given size"""
+        if not self._sheets:
+            self._new_sheet()
+        if self._shelf_x + width > self.sheet_size:
+            # next shelf
+            self._shelf_y += self._shelf_height + PADDING
+            self._shelf_x = 0
+            self._shelf_height = 0
+        if self._shelf_y + height > self.sheet_size:
+            self._new_sheet()
+        x, y = self._shelf_x, self._shelf_y
+        self._shelf_x += width + PADDING
+        self._shelf_height = max(self._shelf_height, height)
+        return x, y
+
+    def add(self, path):
+        """Add image to the sheets
+
+        :returns: dictionary with ``sheet`` (file name relative to
+            ``directory``), ``x``, ``y``, ``width`` and ``height``
+            of the image in the sheet or None when the image is larger
+            than a sheet
+        """
+        key = os.path.abspath(path)
+        if key in self._placed:
+            return dict(self._placed[key])
+        from PIL import Image
+
+        image = Image.open(path).convert('RGBA')
+        width, height = image.size
+        if width > self.sheet_size or height > self.sheet_size:
+            return None
+        x, y = self._place(width, height)
+        self._sheets[-1].paste(image, (x, y))
+        extent = self._extents[-1]
+        extent[0] = max(extent[0], x + width)
+        extent[1] = max(extent[1], y + height)
+        sprite = dict(sheet=self._sheet_file(len(self._sheets) - 1),
+                      x=x, y=y, width=width, height=height)
+        self._placed[key] = sprite
+        return dict(sprite)
+
+    def save(self, hashed=False):
+        """Write the sheets (cropped to the used area)
+
+        With ``hashed``, the files are renamed to names with a hash
+        of their content (see :func:`routleaflet.manifest.hashed_name`).
+
+        :returns: dictionary with the sheet names used in the sprites
+            (see :meth:`add`) as keys and the written files (relative
+            to ``directory``) as values
+        """
+        files = {}
+        for number, sheet in enumerate(self._sheets):
+            sheet = sheet.crop((0, 0) + tuple(self._extents[number]))
+            file_name = self._sheet_file(number)
+            with AtomicFile(os.path.join(self.directory, file_name),
+                            'wb') as output:
+                if self.compression is None:
+                    sheet.save(output.file, 'PNG')
+                else:
+                    sheet.save(output.file, 'PNG',
+                               compress_level=self.compression)
+            if hashed:
+                files[file_name] = rename_to_hashed(self.directory,
+                                                    file_name)
+            else:
+                files[file_name] = file_name
+        return files
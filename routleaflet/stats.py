@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Statistics of raster maps computed in one pass over the data
+
+The map is read block by block (see
+:func:`routleaflet.render.read_raster_blocks`), so the memory use does
+not depend on the size of the map. Univariate statistics, histogram
+and category counts are all computed from the same blocks.
+For floating point maps, the values at the ranks of the quartiles,
+median and percentile are found using additional passes which
+narrow down the range of values containing each rank.
+
+@author: Vaclav Petras <wenzeslaus gmail.com>
+"""
+
+import math
+
+import numpy as np
+
+import grass.script as gs
+
+from routleaflet.render import read_raster_blocks
+
+
+# number of bins of the histogram of floating point maps
+# (same as the default of d.histogram)
+HISTOGRAM_BINS = 255
+# number of bins used to find percentiles of floating point maps
+PERCENTILE_BINS = 10000
+# number of values which can be kept in memory to find exact percentiles
+MAX_EXACT_VALUES = 2 ** 20
+# maximum number of additional passes over the map to find percentiles
+MAX_REFINEMENT_PASSES = 4
+# integer maps with a larger range are treated as floating point maps
+MAX_CATEGORIES = 2 ** 20
+
+
+class RasterStatistics(object):
+    """Statistics of a raster map accumulated block by block
+
+    The range of values (``minimum``, ``maximum``) must be known
+    in advance (e.g. from the range file of the map), so that the bins
+    of the histogram are the same for all blocks.
+
+    For integer maps with a range smaller than :data:`MAX_CATEGORIES`,
+    the number of cells for each category is counted and
+    the percentiles are exact. For other maps, the percentiles are
+    estimated from a histogram with :data:`PERCENTILE_BINS` bins
+    until they are made exact by :meth:`refine`.
+    """
+    def __init__(self, minimum, maximum, integer=False,
+                 bins=HISTOGRAM_BINS):
+        self.range_min = minimum
+        self.range_max = maximum
+        self.integer = integer
+        self.bins = bins
+        self.cells = 0
+        self.null_cells = 0
+        self.n = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.
+        self.sum_abs = 0.
+        self._mean = 0.
+        self._m2 = 0.
+        # exact values and ranges of values at ranks (see refine)
+        self._exact = {}
+        self._intervals = {}
+        if minimum is None or maximum is None:
+            # map with only NULL cells
+            self._counts = None
+            self._fine_counts = None
+            self._bin_counts = None
+        elif integer and maximum - minimum < MAX_CATEGORIES:
+            self._counts = np.zeros(int(maximum - minimum) + 1,
+                                    dtype=np.int64)
+            self._fine_counts = None
+            self._bin_counts = None
+        else:
+            self._counts = None
+            self._fine_counts = np.zeros(PERCENTILE_BINS, dtype=np.int64)
+            self._bin_counts = np.zeros(bins, dtype=np.int64)
+
+    def update(self, block):
+        """Add values from a block (array with NaN for NULL cells)"""
+        self.cells += block.size
+        values = block[~np.isnan(block)]
+        self.null_cells += block.size - values.size
+        if not values.size:
+            return
+        block_min = float(values.min())
+        block_max = float(values.max())
+        if self.n:
+            self.min = min(self.min, block_min)
+            self.max = max(self.max, block_max)
+        else:
+            self.min = block_min
+            self.max = block_max
+        self.sum += float(values.sum())
+        self.sum_abs += float(np.abs(values).sum())
+        # variance of blocks combined using the parallel algorithm
+        # (more precise than the sum of squares)
+        count = values.size
+        block_mean = float(values.mean())
+        block_m2 = float(((values - block_mean) ** 2).sum())
+        total = self.n + count
+        delta = block_mean - self._mean
+        self._mean += delta * count / total
+        self._m2 += block_m2 + delta ** 2 * self.n * count / total
+        self.n = total
+        if self._counts is not None:
+            indices = np.clip((values - self.range_min).astype(np.int64),
+                              0, self._counts.size - 1)
+            self._counts += np.bincount(indices,
+                                        minlength=self._counts.size)
+        else:
+            self._fine_counts += self._count_in_bins(values, PERCENTILE_BINS)
+            self._bin_counts += self._count_in_bins(values, self.bins)
+
+    def _count_in_bins(self, values, bins):
+        width = self.range_max - self.range_min
+        if width <= 0:
+            indices = np.zeros(values.size, dtype=np.int64)
+        else:
+            indices = ((values - self.range_min) / width * bins).astype(
+                np.int64)
+        return np.bincount(np.clip(indices, 0, bins - 1), minlength=bins)
+
+    @property
+    def mean(self):
+        return self._mean if self.n else None
+
+    @property
+    def variance(self):
+        # population variance as computed by r.univar
+        return self._m2 / self.n if self.n else None
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance) if self.n else None
+
+    def value_at_rank(self, rank):
+        """Returns value of the cell with the given rank (from 0)
+
+        The value is exact for integer maps with category counts
+        and for ranks refined by :meth:`refine`, otherwise it is
+        interpolated within a bin of the histogram.
+        """
+        if rank in self._exact:
+            return self._exact[rank]
+        if self._counts is not None:
+            cumulative = np.cumsum(self._counts)
+            index = int(np.searchsorted(cumulative, rank, side='right'))
+            return self.range_min + index
+        cumulative = np.cumsum(self._fine_counts)
+        index = int(np.searchsorted(cumulative, rank, side='right'))
+        index = min(index, PERCENTILE_BINS - 1)
+        before = cumulative[index - 1] if index else 0
+        count = self._fine_counts[index]
+        width = (self.range_max - self.range_min) / float(PERCENTILE_BINS)
+        fraction = (rank - before + 0.5) / count if count else 0.5
+        value = self.range_min + (index + fraction) * width
+        # the estimate cannot be outside of the actual values
+        return min(max(value, self.min), self.max)
+
+    def _percentile_rank(self, percent):
+        # the same rank as in r.univar
+        return max(int(self.n * percent / 100. - 0.5), 0)
+
+    def percentile(self, percent):
+        """Returns percentile using the same rank as r.univar"""
+        return self.value_at_rank(self._percentile_rank(percent))
+
+    def ranks(self):
+        """Returns ranks of the quartiles, median and 90th percentile"""
+        ranks = set(self._percentile_rank(percent)
+                    for percent in (25, 75, 90))
+        if self.n % 2:
+            ranks.add((self.n - 1) // 2)
+        else:
+            ranks.update((self.n // 2 - 1, self.n // 2))
+        return sorted(ranks)
+
+    @property
+    def exact_percentiles(self):
+        """True if the values at all :meth:`ranks` are exact"""
+        return self._counts is not None or all(
+            rank in self._exact for rank in self.ranks())
+
+    def needs_refinement(self):
+        """True if the percentiles can be made exact by :meth:`refine`"""
+        return bool(self.n) and not self.exact_percentiles
+
+    def _initial_interval(self, rank):
+        """Returns range of values and count of the bin with the rank"""
+        cumulative = np.cumsum(self._fine_counts)
+        index = int(np.searchsorted(cumulative, rank, side='right'))
+        index = min(index, PERCENTILE_BINS - 1)
+        width = (self.range_max - self.range_min) / float(PERCENTILE_BINS)
+        return (self.range_min + index * width,
+                self.range_min + (index + 1) * width,
+                int(self._fine_counts[index]))
+
+    def refine(self, blocks, max_values=MAX_EXACT_VALUES):
+        """Narrow down the values at the ranks using another pass
+
+        For each rank, the cells with values in the range known to
+        contain the rank are either kept (when there are at most
+        ``max_values`` of them for all the ranks) and the value is
+        selected exactly, or they are counted in a finer histogram
+        which gives a narrower range for the next pass. The range is
+        checked by counting the cells below it, so rounding of the bins
+        cannot make the result wrong.
+
+        :param blocks: iterable with blocks of the same map
+            (e.g. from :func:`routleaflet.render.read_raster_blocks`)
+        """
+        pending = [rank for rank in self.ranks() if rank not in self._exact]
+        for rank in pending:
+            if rank not in self._intervals:
+                self._intervals[rank] = self._initial_interval(rank)
+        # more ranks often fall into one bin
+        intervals = dict((self._intervals[rank][:2], self._intervals[rank][2])
+                         for rank in pending)
+        budget = max_values // len(intervals)
+        states = {}
+        for interval, count in intervals.items():
+            states[interval] = dict(
+                below=0, inside=0, low=None, high=None,
+                values=[] if count <= budget else None,
+                counts=np.zeros(PERCENTILE_BINS, dtype=np.int64))
+        for block in blocks:
+            values = block[~np.isnan(block)]
+            if not values.size:
+                continue
+            for (low, high), state in states.items():
+                state['below'] += int(np.count_nonzero(values < low))
+                selected = values[(values >= low) & (values <= high)]
+                if not selected.size:
+                    continue
+                state['inside'] += selected.size
+                selected_min = float(selected.min())
+                selected_max = float(selected.max())
+                if state['low'] is None:
+                    state['low'] = selected_min
+                    state['high'] = selected_max
+                else:
+                    state['low'] = min(state['low'], selected_min)
+                    state['high'] = max(state['high'], selected_max)
+                if state['values'] is not None:
+                    state['values'].append(selected)
+                elif high > low:
+                    indices = ((selected - low) / (high - low) *
+                               PERCENTILE_BINS).astype(np.int64)
+                    state['counts'] += np.bincount(
+                        np.clip(indices, 0, PERCENTILE_BINS - 1),
+                        minlength=PERCENTILE_BINS)
+        for rank in pending:
+            low, high = self._intervals[rank][:2]
+            state = states[(low, high)]
+            offset = rank - state['below']
+            if not 0 <= offset < state['inside']:
+                # the range does not contain the rank, start again
+                self._intervals[rank] = (self.min, self.max, self.n)
+                continue
+            if state['low'] == state['high']:
+                self._exact[rank] = state['low']
+            elif state['values'] is not None:
+                values = np.concatenate(state['values'])
+                self._exact[rank] = float(np.partition(values, offset)[offset])
+            else:
+                cumulative = np.cumsum(state['counts'])
+                index = int(np.searchsorted(cumulative, offset, side='right'))
+                index = min(index, PERCENTILE_BINS - 1)
+                width = (high - low) / float(PERCENTILE_BINS)
+                # the bin is made a bit wider than computed from the bins,
+                # so it contains values rounded to a neighbouring bin
+                margin = width / 1000.
+                self._intervals[rank] = (
+                    max(low + index * width - margin, state['low']),
+                    min(low + (index + 1) * width + margin, state['high']),
+                    int(state['counts'][index]))
+
+    @property
+    def median(self):
+        if self.n % 2:
+            return self.value_at_rank((self.n - 1) // 2)
+        return (self.value_at_rank(self.n // 2 - 1) +
+                self.value_at_rank(self.n // 2)) / 2.
+
+    def categories(self):
+        """Returns list of (category, number of cells) pairs
+
+        Only categories with non-zero count are included.
+        Returns None when the categories were not counted.
+        """
+        if self._counts is None:
+            return None
+        indices = np.nonzero(self._counts)[0]
+        return [(int(self.range_min + index), int(self._counts[index]))
+                for index in indices]
+
+    @property
+    def category_bins(self):
+        """True if each category has its own bin in :meth:`histogram`"""
+        return (self._counts is not None and
+                np.count_nonzero(self._counts) <= self.bins)
+
+    def histogram(self):
+        """Returns histogram as a list of (low, high, count) tuples
+
+        For integer maps with at most ``bins`` categories, each category
+        has its own bin (low and high are the same). For integer maps
+        with more categories, the range of categories is divided into
+        at most ``bins`` bins of the same number of categories
+        (as in d.histogram), low is the first category of the bin and
+        high is the first category of the next bin. Otherwise, the range
+        of the map is divided into ``bins`` bins.
+        """
+        if self.category_bins:
+            return [(category, category, count)
+                    for category, count in self.categories()]
+        if self._counts is not None:
+            present = np.nonzero(self._counts)[0]
+            first = int(present[0])
+            span = int(present[-1]) - first + 1
+            width = -(-span // self.bins)
+            starts = np.arange(first, first + span, width)
+            counts = np.add.reduceat(self._counts[first:first + span],
+                                     starts - first)
+            start = int(self.range_min)
+            return [(start + int(low), start + int(low) + width, int(count))
+                    for low, count in zip(starts, counts)]
+        if self._bin_counts is None:
+            return []
+        counts = self._bin_counts
+        width = (self.range_max - self.range_min) / float(self.bins)
+        return [(self.range_min + i * width,
+                 self.range_min + (i + 1) * width, int(counts[i]))
+                for i in range(self.bins)]
+
+    def summary(self):
+        """Returns dictionary with the univariate statistics"""
+        summary = {'cells': self.cells, 'null_cells': self.null_cells,
+                   'n': self.n}
+        if self.n:
+            summary.update({
+                'min': self.min, 'max': self.max,
+                'mean': self.mean, 'stddev': self.stddev,
+                'variance': self.variance, 'sum': self.sum,
+                'first_quartile': self.percentile(25),
+                'median': self.median,
+                'third_quartile': self.percentile(75),
+                'percentile_90': self.percentile(90),
+                'exact_percentiles': self.exact_percentiles})
+        return summary
+
+    def univar_text(self):
+        """Returns statistics formatted as the output of r.univar -e"""
+        lines = ["total null and non-null cells: %d" % self.cells,
+                 "total null cells: %d" % self.null_cells,
+                 "",
+                 "Of the non-null cells:",
+                 "----------------------"]
+        if not self.n:
+            lines.append("n: 0")
+            return '\n'.join(lines) + '\n'
+        if self.exact_percentiles:
+            estimate = ""
+        else:
+            estimate = " (estimate)"
+        if self.mean:
+            coefficient = 100 * self.stddev / abs(self.mean)
+        else:
+            coefficient = float('nan')
+        lines.extend([
+            "n: %d" % self.n,
+            "minimum: %g" % self.min,
+            "maximum: %g" % self.max,
+            "range: %g" % (self.max - self.min),
+            "mean: %g" % self.mean,
+            "mean of absolute values: %g" % (self.sum_abs / self.n),
+            "standard deviation: %g" % self.stddev,
+            "variance: %g" % self.variance,
+            "variation coefficient: %g %%" % coefficient,
+            "sum: %.15g" % self.sum,
+            "1st quartile%s: %g" % (estimate, self.percentile(25)),
+            "median (%s number of cells)%s: %g" % (
+                'odd' if self.n % 2 else 'even', estimate, self.median),
+            "3rd quartile%s: %g" % (estimate, self.percentile(75)),
+            "90th percentile%s: %g" % (estimate, self.percentile(90))])
+        return '\n'.join(lines) + '\n'
+
+
+def compute_statistics(map_name, bins=HISTOGRAM_BINS, env=None):
+    """Compute statistics of a raster map in the current region
+
+    The map is read once, floating point maps are read again
+    (usually only once more) to find exact percentiles
+    (see :meth:`RasterStatistics.refine`). The range of the map
+    and its type are taken from the map metadata.
+
+    :returns: :class:`RasterStatistics` object
+    """
+    info = gs.raster_info(map_name, env=env)
+    integer = info['datatype'] == 'CELL'
+    statistics = RasterStatistics(info['min'], info['max'],
+                                  integer=integer, bins=bins)
+    for block in read_raster_blocks(map_name, env=env):
+        statistics.update(block)
+    passes = 0
+    while statistics.needs_refinement() and passes < MAX_REFINEMENT_PASSES:
+        statistics.refine(read_raster_blocks(map_name, env=env))
+        passes += 1
+    return statistics
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Running of independent tasks (e.g. products of one map) in threads
+
+@author: Vaclav Petras <wenzeslaus gmail.com>
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+
+def _run_timed(function, args, kwargs):
+    """Run function and return (success, result or error, seconds)"""
+    start = time.time()
+    try:
+        result = function(*args, **kwargs)
+    except (Exception, SystemExit) as error:
+        # fatal error in a thread must be raised by the waiting thread
+        # (and the pool does not pass SystemExit at all)
+        return False, error, time.time() - start
+    return True, result, time.time() - start
+
+
+class TaskGraph(object):
+    """Tasks with dependencies executed by a pool of threads
+
+    A task runs as soon as all the tasks it depends on are finished,
+    the results of these tasks are passed to it as additional positional
+    arguments (after ``args``). Tasks can depend only on tasks added
+    before, so there are no cycles.
+
+    The tasks run in threads, so they should spend most of the time
+    in subprocesses (GRASS modules) or in code which releases the GIL
+    (e.g. NumPy or PIL). Each task which sets environment variables
+    (e.g. ``GRASS_RENDER_*``) needs its own copy of the environment.
+
+    The graph can be started (:meth:`start`) and the calling thread
+    can do other work before it waits for the results (:meth:`wait`).
+    Tasks are started as soon as their dependencies are finished,
+    also while the calling thread does the other work.
+    Run time of each task is available in :attr:`timings` afterwards.
+    """
+    def __init__(self):
+        self._tasks = OrderedDict()
+        self._pool = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._waiting = None
+        self._running = 0
+        self._error = None
+        self.results = {}
+        self.timings = OrderedDict()
+
+    def add(self, name, function, args=(), kwargs=None, depends=()):
+        """Add task to the graph (before the graph is started)"""
+        if name in self._tasks:
+            raise ValueError("Task <%s> was already added" % name)
+        for dependency in depends:
+            if dependency not in self._tasks:
+                raise ValueError("Task <%s> depends on unknown task <%s>"
+                                 % (name, dependency))
+        self._tasks[name] = (function, tuple(args), kwargs or {},
+                             tuple(depends))
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def _submit_ready(self):
+        # called with the lock held
+        for name in list(self._waiting):
+            function, args, kwargs, depends = self._tasks[name]
+            if any(dependency not in self.results
+                   for dependency in depends):
+                continue
+            self._waiting.remove(name)
+            args = args + tuple(self.results[dependency]
+                                for dependency in depends)
+            self._pool.apply_async(
+                _run_timed, (function, args, kwargs),
+                callback=lambda outcome, name=name: self._finished(
+                    name, outcome))
+            self._running += 1
+
+    def _finished(self, name, outcome):
+        # called in the result handler thread of the pool
+        success, result, seconds = outcome
+        with self._lock:
+            self._running -= 1
+            self.timings[name] = seconds
+            if success:
+                self.results[name] = result
+                if self._error is None:
+                    self._submit_ready()
+            elif self._error is None:
+                self._error = result
+            if not self._running:
+                self._done.set()
+
+    def start(self, nprocs=1):
+        """Start the tasks which do not depend on other tasks
+
+        :param nprocs: number of threads
+        """
+        self._pool = ThreadPool(max(1, min(nprocs, len(self._tasks) or 1)))
+        self._waiting = list(self._tasks)
+        with self._lock:
+            self._submit_ready()
+            if not self._running:
+                self._done.set()
+
+    def wait(self):
+        """Wait for all the tasks and return their results
+
+        When a task fails, the error is raised after the tasks which
+        are already running are finished (the others are not started).
+
+        :returns: dictionary with task names as keys
+        """
+        self._done.wait()
+        self._pool.close()
+        self._pool.join()
+        if self._error is not None:
+            raise self._error
+        return self.results
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Export of raster maps as XYZ tile pyramids in Spherical Mercator
+
+The tiles follow the scheme used by OpenStreetMap and Leaflet
+(``L.tileLayer``), i.e. 256 by 256 pixels, EPSG:3857, tile (0, 0) in the
+north-west corner. The map needs to be in a location with EPSG:3857.
+
+@author: Vaclav Petras <wenzeslaus gmail.com>
+"""
+
+import os
+import math
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import grass.script as gs
+
+from routleaflet.utils import get_region, region_env_string
+
+
+TILE_SIZE = 256
+# half of the extent of EPSG:3857 in meters
+ORIGIN_SHIFT = 20037508.342789244
+# number of tiles in a row or column of a block rendered at once
+BLOCK_TILES = 8
+MAX_ZOOM = 24
+
+
+def tile_extent_size(zoom):
+    """Returns width (and height) of one tile in meters"""
+    return 2 * ORIGIN_SHIFT / 2 ** zoom
+
+
+def zoom_for_resolution(resolution):
+    """Returns the lowest zoom level with pixels smaller than resolution"""
+    zoom = math.ceil(math.log(2 * ORIGIN_SHIFT / (TILE_SIZE * resolution),
+                              2))
+    return int(min(max(zoom, 0), MAX_ZOOM))
+
+
+def tile_range(region, zoom):
+    """Returns range of tiles (first x, first y, last x, last y)
+
+    The range covers the region given as a dictionary with ``north``,
+    ``south``, ``east`` and ``west`` keys.
+    """
+    size = tile_extent_size(zoom)
+    last = 2 ** zoom - 1
+    west = float(region['west'])
+    east = float(region['east'])
+    north = float(region['north'])
+    south = float(region['south'])
+    # tolerance for regions which are already aligned with the tiles
+    tolerance = 1e-6
+    first_x = int(math.floor((west + ORIGIN_SHIFT) / size + tolerance))
+    last_x = int(math.ceil((east + ORIGIN_SHIFT) / size - tolerance)) - 1
+    first_y = int(math.floor((ORIGIN_SHIFT - north) / size + tolerance))
+    last_y = int(math.ceil((ORIGIN_SHIFT - south) / size - tolerance)) - 1
+    return (max(first_x, 0), max(first_y, 0),
+            min(max(last_x, first_x), last), min(max(last_y, first_y), last))
+
+
+def tile_range_region(tiles, zoom):
+    """Returns region (dictionary) which exactly covers range of tiles"""
+    first_x, first_y, last_x, last_y = tiles
+    size = tile_extent_size(zoom)
+    return {'west': first_x * size - ORIGIN_SHIFT,
+            'east': (last_x + 1) * size - ORIGIN_SHIFT,
+            'north': ORIGIN_SHIFT - first_y * size,
+            'south': ORIGIN_SHIFT - (last_y + 1) * size,
+            'rows': (last_y - first_y + 1) * TILE_SIZE,
+            'cols': (last_x - first_x + 1) * TILE_SIZE}
+
+
+def tile_grid_region(region, zoom):
+    """Returns region aligned with tiles of the zoom level
+
+    The returned region covers the given region and its cells are
+    the pixels of the tiles.
+    """
+    return tile_range_region(tile_range(region, zoom), zoom)
+
+
+def tile_path(directory, zoom, x, y):
+    return os.path.join(directory, str(zoom), str(x), str(y) + '.png')
+
+
+def _save_tile(image, directory, zoom, x, y, compression):
+    path = tile_path(directory, zoom, x, y)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        # directory exists (possibly created by another thread)
+        if not os.path.isdir(os.path.dirname(path)):
+            raise
+    image.save(path, 'PNG', compress_level=compression)
+
+
+def _is_empty(image):
+    """Checks if image is fully transparent"""
+    if image.mode != 'RGBA':
+        return False
+    return image.split()[-1].getbbox() is None
+
+
+def _render_block(map_name, directory, zoom, block, compression,
+                  routpng_flags, base_region, backend, env):
+    """Render one block of tiles and split it into tile files"""
+    from PIL import Image
+    from routleaflet.pngproj import raster_to_png
+
+    first_x, first_y, last_x, last_y = block
+    env = env.copy()
+    env['GRASS_REGION'] = region_env_string(
+        base_region, tile_range_region(block, zoom))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        block_file = os.path.join(tmp_dir, 'block.png')
+        # no compression for the temporary image
+        raster_to_png(map_name, block_file, compression=0,
+                      routpng_flags=routpng_flags, backend=backend,
+                      env=env)
+        image = Image.open(block_file)
+        image.load()
+    finally:
+        shutil.rmtree(tmp_dir)
+    written = []
+    for x in range(first_x, last_x + 1):
+        for y in range(first_y, last_y + 1):
+            left = (x - first_x) * TILE_SIZE
+            upper = (y - first_y) * TILE_SIZE
+            tile = image.crop((left, upper,
+                               left + TILE_SIZE, upper + TILE_SIZE))
+            if _is_empty(tile):
+                continue
+            _save_tile(tile, directory, zoom, x, y, compression)
+            written.append((x, y))
+    return written
+
+
+def _render_overview(directory, zoom, x, y, compression):
+    """Create one tile by downsampling four tiles of the next level"""
+    from PIL import Image
+
+    image = Image.new('RGBA', (2 * TILE_SIZE, 2 * TILE_SIZE))
+    for dx in (0, 1):
+        for dy in (0, 1):
+            path = tile_path(directory, zoom + 1, 2 * x + dx, 2 * y + dy)
+            if os.path.exists(path):
+                child = Image.open(path).convert('RGBA')
+                image.paste(child, (dx * TILE_SIZE, dy * TILE_SIZE))
+    resample = getattr(Image, 'BOX', Image.BILINEAR)
+    image = image.resize((TILE_SIZE, TILE_SIZE), resample)
+    if _is_empty(image):
+        return None
+    _save_tile(image, directory, zoom, x, y, compression)
+    return (x, y)
+
+
+def export_tiles(map_name, directory, zoom, compression=6,
+                 routpng_flags='t', min_zoom=0, nprocs=1, backend=None,
+                 env=None):
+    """Export raster map as tiles for all zoom levels up to ``zoom``
+
+    The tiles for ``zoom`` are rendered from the map in blocks
+    (using the current region extent), the tiles for the lower zoom
+    levels are created by downsampling the tiles of the level above.
+    Tiles with only NULL cells (fully transparent) are not written.
+    Rendering and downsampling is done in ``nprocs`` threads.
+    The blocks are rendered using ``backend``
+    (see :func:`routleaflet.pngproj.raster_to_png`).
+
+    Returns dictionary with zoom levels as keys and lists of written
+    tiles (x, y) as values.
+    """
+    if env is None:
+        env = os.environ
+    if compression is None:
+        compression = 6
+    # the flags for world file does not make sense for tiles
+    routpng_flags = (routpng_flags or '').replace('w', '')
+    first_x, first_y, last_x, last_y = tile_range(get_region(env=env), zoom)
+    base_region = gs.region_env(env=env)
+    blocks = []
+    for block_x in range(first_x, last_x + 1, BLOCK_TILES):
+        for block_y in range(first_y, last_y + 1, BLOCK_TILES):
+            blocks.append((block_x, block_y,
+                           min(block_x + BLOCK_TILES - 1, last_x),
+                           min(block_y + BLOCK_TILES - 1, last_y)))
+
+    pool = ThreadPool(nprocs)
+    try:
+        tiles = {}
+        results = pool.map(
+            lambda block: _render_block(map_name, directory, zoom, block,
+                                        compression, routpng_flags,
+                                        base_region, backend, env),
+            blocks)
+        tiles[zoom] = sorted(tile for result in results for tile in result)
+        for level in range(zoom - 1, min_zoom - 1, -1):
+            parents = sorted(set((x // 2, y // 2)
+                                 for x, y in tiles[level + 1]))
+            results = pool.map(
+                lambda tile: _render_overview(directory, level,
+                                              tile[0], tile[1],
+                                              compression),
+                parents)
+            tiles[level] = [tile for tile in results if tile]
+    finally:
+        pool.close()
+        pool.join()
+    return tiles
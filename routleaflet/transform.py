@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Transformation of coordinates between projections
+
+Coordinates are transformed as whole NumPy arrays. The pyproj package
+is used when available, so no process is started. Otherwise, all
+coordinates are transformed by one call of m.proj.
+
+@author: Vaclav Petras <wenzeslaus gmail.com>
+"""
+
+import threading
+
+import numpy as np
+
+import grass.script as gs
+
+try:
+    import pyproj
+    if not hasattr(pyproj, 'Transformer'):
+        # pyproj older than 2.1
+        pyproj = None
+except ImportError:
+    pyproj = None
+
+
+WGS84_PROJ_STRING = '+proj=longlat +datum=WGS84 +no_defs'
+
+# number of points sampled along each edge of an extent
+# (same as the default in GDAL)
+DEFAULT_DENSIFY = 21
+
+# transformers are not shared between threads
+_local = threading.local()
+
+# transformed extents (the values are never modified)
+_extent_cache = {}
+_EXTENT_CACHE_SIZE = 1024
+
+
+def get_transformer(from_proj, to_proj):
+    """Returns (cached) pyproj transformer for two PROJ strings
+
+    Transformers are cached for each thread by the pair of strings.
+    Returns None when pyproj is not available.
+    """
+    if pyproj is None:
+        return None
+    transformers = getattr(_local, 'transformers', None)
+    if transformers is None:
+        transformers = _local.transformers = {}
+    key = (from_proj, to_proj)
+    transformer = transformers.get(key)
+    if transformer is None:
+        transformer = pyproj.Transformer.from_crs(
+            pyproj.CRS.from_proj4(from_proj), pyproj.CRS.from_proj4(to_proj),
+            always_xy=True)
+        transformers[key] = transformer
+    return transformer
+
+
+def _transform_using_mproj(x, y, from_proj, to_proj, env=None):
+    proj_input = '\n'.join('{0!r} {1!r}'.format(float(xi), float(yi))
+                           for xi, yi in zip(x, y))
+    proc = gs.start_command('m.proj', input='-', separator='space',
+                            flags='d', proj_in=from_proj, proj_out=to_proj,
+                            stdin=gs.PIPE, stdout=gs.PIPE, stderr=gs.PIPE,
+                            env=env)
+    proj_output, errors = proc.communicate(gs.encode(proj_input))
+    if proc.returncode:
+        raise RuntimeError("m.proj error: %s" % gs.decode(errors))
+    # m.proj adds z coordinate
+    lines = gs.decode(proj_output).split()
+    try:
+        values = np.array(lines, dtype=np.float64).reshape(len(x), -1)
+    except ValueError:
+        raise RuntimeError("m.proj returned unexpected output: %s"
+                           % gs.decode(proj_output))
+    return values[:, 0], values[:, 1]
+
+
+def transform_coordinates(x, y, from_proj, to_proj, env=None):
+    """Transform coordinates from one projection to another
+
+    :param x: array of x coordinates (easting, longitude)
+    :param y: array of y coordinates (northing, latitude)
+    :param from_proj: PROJ string of the source projection
+    :param to_proj: PROJ string of the target projection
+    :param env: environment for m.proj (used only without pyproj)
+
+    Returns tuple of NumPy arrays of the transformed x and y coordinates.
+    """
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    if not x.size:
+        return x, y
+    transformer = get_transformer(from_proj, to_proj)
+    if transformer:
+        new_x, new_y = transformer.transform(x, y)
+        return np.asarray(new_x), np.asarray(new_y)
+    return _transform_using_mproj(x, y, from_proj, to_proj, env=env)
+
+
+def _extent_edges(keys, points):
+    """Sample points along edges of extents given by cache keys
+
+    Returns arrays of x and y coordinates with shape
+    (number of extents, 4 * points).
+    """
+    corners = np.array([key[2:6] for key in keys], dtype=np.float64)
+    east, north, west, south = [column[:, np.newaxis]
+                                for column in corners.T]
+    steps = np.linspace(0, 1, points)
+    along_x = west + (east - west) * steps
+    along_y = south + (north - south) * steps
+    x = np.hstack([along_x, along_x,
+                   np.repeat(west, points, axis=1),
+                   np.repeat(east, points, axis=1)])
+    y = np.hstack([np.repeat(south, points, axis=1),
+                   np.repeat(north, points, axis=1),
+                   along_y, along_y])
+    return x, y
+
+
+def _transform_edges(keys, points, from_proj, to_proj, env=None):
+    x, y = _extent_edges(keys, points)
+    new_x, new_y = transform_coordinates(x, y, from_proj, to_proj, env=env)
+    # points which cannot be transformed are ignored
+    new_x = np.where(np.isfinite(new_x), new_x, np.nan).reshape(x.shape)
+    new_y = np.where(np.isfinite(new_y), new_y, np.nan).reshape(y.shape)
+    if np.isnan(new_x).all(axis=1).any() or np.isnan(new_y).all(axis=1).any():
+        raise RuntimeError("Extent cannot be transformed from <%s> to <%s>"
+                           % (from_proj, to_proj))
+    return [{'east': float(np.nanmax(new_x[i])),
+             'north': float(np.nanmax(new_y[i])),
+             'west': float(np.nanmin(new_x[i])),
+             'south': float(np.nanmin(new_y[i]))}
+            for i in range(len(keys))]
+
+
+def _transform_corners(keys, from_proj, to_proj, env=None):
+    x = []
+    y = []
+    for key in keys:
+        x.extend([key[2], key[4]])
+        y.extend([key[3], key[5]])
+    new_x, new_y = transform_coordinates(x, y, from_proj, to_proj, env=env)
+    return [{'east': float(new_x[2 * i]),
+             'north': float(new_y[2 * i]),
+             'west': float(new_x[2 * i + 1]),
+             'south': float(new_y[2 * i + 1])}
+            for i in range(len(keys))]
+
+
+def transform_extents(extents, from_proj, to_proj, densify=None, env=None):
+    """Transform more extents at once
+
+    Each extent is a dictionary with ``east``, ``north``, ``west`` and
+    ``south`` keys (values can be also strings).
+
+    Without ``densify``, only the corners (east, north) and (west, south)
+    are transformed. This is not enough when the edges of the extent
+    are curved in the target projection (e.g. for conic projections).
+    With ``densify``, the given number of points is sampled along each
+    edge of the extent and the result is the bounding box of all the
+    transformed points.
+
+    All extents are transformed in one call, so without pyproj, m.proj
+    is called only once. Results are cached, so extents which were
+    already transformed (e.g. the same region for all maps in a time
+    series) are not transformed again.
+
+    Returns list of new dictionaries with the four keys.
+    """
+    if densify is not None and densify < 2:
+        densify = None
+    keys = [(from_proj, to_proj,
+             float(extent['east']), float(extent['north']),
+             float(extent['west']), float(extent['south']),
+             densify)
+            for extent in extents]
+    transformed = {}
+    for key in keys:
+        # the cache can be cleared by another thread meanwhile
+        extent = _extent_cache.get(key)
+        if extent is not None:
+            transformed[key] = extent
+    missing = sorted(set(keys) - set(transformed))
+    if missing:
+        if densify:
+            new_extents = _transform_edges(missing, densify,
+                                           from_proj, to_proj, env=env)
+        else:
+            new_extents = _transform_corners(missing,
+                                             from_proj, to_proj, env=env)
+        if len(_extent_cache) + len(missing) > _EXTENT_CACHE_SIZE:
+            _extent_cache.clear()
+        for key, extent in zip(missing, new_extents):
+            transformed[key] = extent
+            _extent_cache[key] = extent
+    return [dict(transformed[key]) for key in keys]
+
+
+def transform_extent(extent, from_proj, to_proj, densify=None, env=None):
+    """Transform one extent (see :func:`transform_extents`)"""
+    return transform_extents([extent], from_proj, to_proj,
+                             densify=densify, env=env)[0]
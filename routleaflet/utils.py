@@ -8,17 +8,20 @@ Created on Fri Nov 29 19:28:54 2013
 
 import os
 import copy
+import math
 import shutil
 
 import grass.script as gs
 
+from routleaflet.transform import transform_extent, DEFAULT_DENSIFY
 
-def get_region():
+
+def get_region(env=None):
     """Returns current computational region as dictionary.
 
     Adds long key names.
     """
-    region = gs.region()
+    region = gs.region(env=env)
     region['east'] = region['e']
     region['west'] = region['w']
     region['north'] = region['n']
@@ -26,7 +29,7 @@ def get_region():
     return region
 
 
-def set_region(region):
+def set_region(region, env=None):
     """Sets the current computational region from a dictionary.
 
     Accepts long key names and removes key from ``grass.script.region()``
@@ -41,38 +44,125 @@ def set_region(region):
         region['w'] = region['west']
     for key in ['north', 'south', 'east', 'west',
                 'zone', 'projection', 'cells']:
-        del region[key]
-    gs.run_command('g.region', **region)
+        region.pop(key, None)
+    gs.run_command('g.region', env=env, **region)
 
 
-def get_location_proj_string():
-    out = gs.read_command('g.proj', flags='jf')
+def get_location_proj_string(env=None):
+    out = gs.read_command('g.proj', flags='jf', env=env)
     return out.strip()
 
 
-# TODO: this does not take care of resolution (it's just extent)
-def reproject_region(region, from_proj, to_proj):
+def create_location(location, epsg, env=None):
+    """Creates a new location from EPSG code
+
+    The location is created in the GIS Database set in the GISRC file
+    (which is given by ``env``). Unlike ``grass.script.create_location()``,
+    this does not modify the GISRC file or the environment.
+    """
+    gs.run_command('g.proj', flags='t', epsg=epsg, location=location,
+                   quiet=True, env=env)
+
+
+def reproject_region(region, from_proj, to_proj, densify=DEFAULT_DENSIFY,
+                     env=None):
+    """Reproject extent of a region
+
+    The result is the bounding box of points sampled along the region
+    edges (see :func:`routleaflet.transform.transform_extents`).
+    Number of rows and columns is set to keep the resolution of the
+    source region (see :func:`reprojected_region_size`).
+    """
+    src_region = region
+    region = region.copy()
+    region.update(transform_extent(src_region, from_proj=from_proj,
+                                   to_proj=to_proj, densify=densify,
+                                   env=env))
+    rows, cols = reprojected_region_size(region, src_region=src_region,
+                                         from_proj=from_proj,
+                                         to_proj=to_proj, env=env)
+    # resolution is given by rows and columns
+    region.pop('nsres', None)
+    region.pop('ewres', None)
+    region['rows'] = rows
+    region['cols'] = cols
+    return region
+
+
+def reprojected_region_size(region, src_region, from_proj, to_proj,
+                            env=None):
+    """Returns rows and columns for reprojected extent of a region
+
+    The cells are square and their size is derived from the source
+    region, so that the diagonal of the source region has the same
+    number of cells in the target projection as it has in the source.
+    The ``region`` is the extent of ``src_region`` in the target
+    projection (it can be larger than the transformed corners).
+    """
+    corners = transform_extent(src_region, from_proj=from_proj,
+                               to_proj=to_proj, env=env)
+    diagonal = math.hypot(corners['east'] - corners['west'],
+                          corners['north'] - corners['south'])
+    cells_diagonal = math.hypot(int(src_region['rows']),
+                                int(src_region['cols']))
+    resolution = diagonal / cells_diagonal
+    width = float(region['east']) - float(region['west'])
+    height = float(region['north']) - float(region['south'])
+    cols = max(1, int(round(width / resolution)))
+    rows = max(1, int(round(height / resolution)))
+    return rows, cols
+
+
+def limit_region_size(region, max_size):
+    """Limits number of rows and columns of a region to a maximum
+
+    Returns a new dictionary where both rows and columns are at most
+    ``max_size`` and their ratio is kept. The extent is not changed,
+    so the resolution is given only by rows and columns.
+    """
     region = region.copy()
-    proj_input = '{east} {north}\n{west} {south}'.format(**region)
-    proc = gs.start_command('m.proj', input='-', separator=' , ',
-                            proj_in=from_proj, proj_out=to_proj,
-                            stdin=gs.PIPE, stdout=gs.PIPE, stderr=gs.PIPE)
-    proc.stdin.write(gs.encode(proj_input))
-    proc.stdin.close()
-    proc.stdin = None
-    proj_output, stderr = proc.communicate()
-    if proc.returncode:
-        raise RuntimeError("reprojecting region: m.proj error: " + stderr)
-    enws = gs.decode(proj_output).split(os.linesep)
-    elon, nlat, unused = enws[0].split(' ')
-    wlon, slat, unused = enws[1].split(' ')
-    region['east'] = elon
-    region['north'] = nlat
-    region['west'] = wlon
-    region['south'] = slat
+    rows = int(region['rows'])
+    cols = int(region['cols'])
+    if max(rows, cols) > max_size:
+        scale = float(max_size) / max(rows, cols)
+        rows = max(1, int(round(rows * scale)))
+        cols = max(1, int(round(cols * scale)))
+        region.pop('nsres', None)
+        region.pop('ewres', None)
+    region['rows'] = rows
+    region['cols'] = cols
     return region
 
 
+def region_env_string(base, region):
+    """Returns GRASS_REGION value with the extent and size replaced
+
+    :param base: GRASS_REGION value (see :func:`grass.script.region_env`)
+    :param region: dictionary with extent, ``rows`` and ``cols``
+    """
+    values = []
+    for item in base.split(';'):
+        if not item:
+            continue
+        key, value = item.split(':', 1)
+        values.append([key.strip(), value.strip()])
+    north = float(region['north'])
+    south = float(region['south'])
+    east = float(region['east'])
+    west = float(region['west'])
+    rows = int(region['rows'])
+    cols = int(region['cols'])
+    new_values = {
+        'north': north, 'south': south, 'east': east, 'west': west,
+        'rows': rows, 'cols': cols,
+        'n-s resol': (north - south) / rows,
+        'e-w resol': (east - west) / cols}
+    for pair in values:
+        if pair[0] in new_values:
+            pair[1] = repr(new_values[pair[0]])
+    return ';'.join('{0}:{1}'.format(key, value) for key, value in values)
+
+
 def read_env_file(filename):
     keyval = {}
     with open(filename, 'r') as file:
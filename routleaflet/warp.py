@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Reprojection of raster maps using a precomputed warp index
+
+Maps of a space time raster dataset usually have the same region,
+so for each cell of the target region, the same cells of the source
+region are used for every map. The warp index stores the positions
+of the target cell centers in the source region (computed once by
+inverse projection), so reprojecting a map is only reading it and
+one gather from the data array.
+
+The index is stored as a NumPy ``.npy`` file which is memory mapped,
+so it can be shared by more processes. The index can be applied
+to blocks of target rows, so the reprojected map does not need to be
+in memory at once (see :meth:`WarpIndex.apply`).
+
+@author: Vaclav Petras <wenzeslaus gmail.com>
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+from routleaflet.transform import transform_coordinates
+
+
+# interpolation methods (same as for r.proj)
+METHODS = ('nearest', 'bilinear')
+
+# number of target cells transformed at once
+WARP_BLOCK_CELLS = 2 ** 20
+
+
+def _grid(region):
+    """Returns north, west, rows, cols and resolutions of a region"""
+    north = float(region['north'])
+    west = float(region['west'])
+    rows = int(region['rows'])
+    cols = int(region['cols'])
+    nsres = (north - float(region['south'])) / rows
+    ewres = (float(region['east']) - west) / cols
+    return north, west, rows, cols, nsres, ewres
+
+
+def warp_index_key(src_region, src_proj, tgt_region, tgt_proj, method):
+    """Returns string which identifies the index for the given grids"""
+    grids = [[float(region[name]) for name in
+              ('north', 'south', 'east', 'west', 'rows', 'cols')]
+             for region in (src_region, tgt_region)]
+    return hashlib.sha1(json.dumps(
+        [grids, src_proj, tgt_proj, method]).encode('utf-8')).hexdigest()
+
+
+class WarpIndex(object):
+    """Positions of target cells in the source region
+
+    For ``nearest``, the index is an integer array with the shape of
+    the target region with the position of the source cell in the
+    flattened source array. Cells outside of the source region point
+    to an additional NULL cell after the source data.
+
+    For ``bilinear``, the index contains fractional row and column
+    (array with shape ``(2, rows, cols)``) in the source array where
+    0 is the center of the first cell, and NaN outside of the source
+    region. As in r.proj, the result is NULL when any of the four
+    cells used for the interpolation is NULL.
+    """
+    def __init__(self, index, method, source_shape):
+        if method not in METHODS:
+            raise ValueError("Unknown interpolation method <%s>" % method)
+        self.index = index
+        self.method = method
+        self.source_shape = tuple(source_shape)
+
+    @property
+    def shape(self):
+        """Shape of the target array (rows, cols)"""
+        return self.index.shape[-2:]
+
+    @classmethod
+    def create(cls, path, src_region, src_proj, tgt_region, tgt_proj,
+               method, env=None):
+        """Compute the index and store it in a file
+
+        The target cell centers are transformed from the target to
+        the source projection block by block directly into the file,
+        so the memory use does not depend on the size of the region.
+        The file appears only when it is complete.
+
+        :param env: environment for m.proj (used only without pyproj)
+        """
+        from routleaflet.metadata import replace_file, set_default_permissions
+
+        if method not in METHODS:
+            raise ValueError("Unknown interpolation method <%s>" % method)
+        src_north, src_west, src_rows, src_cols, src_nsres, src_ewres = \
+            _grid(src_region)
+        north, west, rows, cols, nsres, ewres = _grid(tgt_region)
+        if method == 'nearest':
+            # positions must fit also the additional NULL cell
+            if src_rows * src_cols < np.iinfo(np.int32).max:
+                dtype = np.int32
+            else:
+                dtype = np.int64
+            shape = (rows, cols)
+        else:
+            dtype = np.float32
+            shape = (2, rows, cols)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=directory,
+                                        prefix='.warp_')
+        os.close(fd)
+        try:
+            index = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                              dtype=dtype, shape=shape)
+            x = west + (np.arange(cols) + 0.5) * ewres
+            block_rows = max(1, WARP_BLOCK_CELLS // cols)
+            for start in range(0, rows, block_rows):
+                stop = min(start + block_rows, rows)
+                y = north - (np.arange(start, stop) + 0.5) * nsres
+                block_x, block_y = np.meshgrid(x, y)
+                src_x, src_y = transform_coordinates(
+                    block_x, block_y, from_proj=tgt_proj, to_proj=src_proj,
+                    env=env)
+                # position in cells from the north-west corner
+                col = ((src_x - src_west) / src_ewres).reshape(block_x.shape)
+                row = ((src_north - src_y) / src_nsres).reshape(block_x.shape)
+                # points which cannot be transformed are outside
+                outside = ~(np.isfinite(col) & np.isfinite(row))
+                col[outside] = -1
+                row[outside] = -1
+                outside |= ((col < 0) | (col >= src_cols) |
+                            (row < 0) | (row >= src_rows))
+                if method == 'nearest':
+                    position = (np.floor(row).astype(np.int64) * src_cols +
+                                np.floor(col).astype(np.int64))
+                    position[outside] = src_rows * src_cols
+                    index[start:stop] = position
+                else:
+                    # relative to cell centers
+                    row -= 0.5
+                    col -= 0.5
+                    row[outside] = np.nan
+                    col[outside] = np.nan
+                    index[0, start:stop] = row
+                    index[1, start:stop] = col
+            index.flush()
+            del index
+            set_default_permissions(tmp_path)
+            replace_file(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return cls.load(path, method, source_shape=(src_rows, src_cols))
+
+    @classmethod
+    def load(cls, path, method, source_shape):
+        """Load (memory map) index stored by :meth:`create`"""
+        return cls(np.load(path, mmap_mode='r'), method,
+                   source_shape=source_shape)
+
+    def apply(self, data, rows=None, cols=None):
+        """Reproject data array of a map in the source region
+
+        Only part of the target can be computed by giving the target
+        rows and columns (as slices or arrays of indices), e.g. a block
+        of rows, so only that part of the index is read.
+
+        :param data: 2D array with NaN for NULL cells (can be memory
+            mapped, only the cells used are read)
+        :returns: 2D float64 array in the target region
+        """
+        if data.shape != self.source_shape:
+            raise ValueError("Data with shape %s do not match the index"
+                             " for shape %s" % (data.shape,
+                                                self.source_shape))
+        index = self.index
+        if rows is not None:
+            index = index[..., rows, :]
+        if cols is not None:
+            index = index[..., cols]
+        if self.method == 'nearest':
+            # the last position is for the cells outside of the source
+            position = np.asarray(index)
+            outside = position == data.size
+            result = data.reshape(-1).take(
+                np.minimum(position, data.size - 1))
+            result[outside] = np.nan
+            return result
+        row = np.array(index[0], dtype=np.float64)
+        col = np.array(index[1], dtype=np.float64)
+        outside = np.isnan(row)
+        row[outside] = 0
+        col[outside] = 0
+        row0 = np.floor(row)
+        col0 = np.floor(col)
+        row_weight = row - row0
+        col_weight = col - col0
+        # cells next to the edge use the edge cells
+        rows, cols = self.source_shape
+        row0 = row0.astype(np.intp)
+        col0 = col0.astype(np.intp)
+        row1 = np.clip(row0 + 1, 0, rows - 1)
+        col1 = np.clip(col0 + 1, 0, cols - 1)
+        np.clip(row0, 0, rows - 1, out=row0)
+        np.clip(col0, 0, cols - 1, out=col0)
+        top = (data[row0, col0] * (1 - col_weight) +
+               data[row0, col1] * col_weight)
+        bottom = (data[row1, col0] * (1 - col_weight) +
+                  data[row1, col1] * col_weight)
+        result = top * (1 - row_weight) + bottom * row_weight
+        result[outside] = np.nan
+        return result
+
+
+class SourceData(object):
+    """Source map read for reprojection using a warp index
+
+    When the data need more than ``memory`` (in MB), they are written
+    block by block to a temporary memory mapped file in ``directory``
+    instead of being held in memory. The file is removed by
+    :meth:`close`.
+
+    The data of the last map are kept, so one object can be used
+    to reproject one map into more projections reading it only once
+    (see :meth:`get`).
+    """
+    def __init__(self, memory=None, directory=None):
+        self.memory = memory
+        self.directory = directory
+        self._path = None
+        self._key = None
+        self._data = None
+
+    def get(self, map_name, region, env=None):
+        """Returns data of the map, reads it only when not read yet
+
+        The data are read again for a different map or region
+        (see :meth:`read`).
+        """
+        key = (map_name, [float(region[name]) for name in
+                          ('north', 'south', 'east', 'west',
+                           'rows', 'cols')])
+        if key != self._key:
+            self._data = self.read(map_name, region, env=env)
+            self._key = key
+        return self._data
+
+    def read(self, map_name, region, env=None):
+        """Read map in the region (the current region in ``env``)
+
+        :returns: 2D float64 array with NaN for NULL cells
+        """
+        from routleaflet.render import read_raster, read_raster_blocks
+
+        self.close()
+        rows = int(region['rows'])
+        cols = int(region['cols'])
+        if not self.memory or rows * cols * 8 <= self.memory * 1024 ** 2:
+            return read_raster(map_name, env=env)
+        fd, self._path = tempfile.mkstemp(suffix='.npy', dir=self.directory,
+                                          prefix='.source_')
+        os.close(fd)
+        data = np.lib.format.open_memmap(self._path, mode='w+',
+                                         dtype=np.float64,
+                                         shape=(rows, cols))
+        start = 0
+        for block in read_raster_blocks(map_name, env=env):
+            data[start:start + block.shape[0]] = block
+            start += block.shape[0]
+        data.flush()
+        return data
+
+    def close(self):
+        """Remove the temporary file (if any)"""
+        self._key = None
+        self._data = None
+        if self._path and os.path.exists(self._path):
+            os.remove(self._path)
+        self._path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_warp_index(directory, src_region, src_proj, tgt_region, tgt_proj,
+                   method, env=None):
+    """Returns index for the grids, computes it only when not stored yet
+
+    The index is stored in ``directory`` under a name derived from
+    the grids, projections and method (see :func:`warp_index_key`),
+    so the directory can be shared by more processes and sessions.
+    """
+    path = os.path.join(directory, warp_index_key(
+        src_region, src_proj, tgt_region, tgt_proj, method) + '.npy')
+    source_shape = (int(src_region['rows']), int(src_region['cols']))
+    if os.path.exists(path):
+        return WarpIndex.load(path, method, source_shape=source_shape)
+    return WarpIndex.create(path, src_region, src_proj, tgt_region,
+                            tgt_proj, method=method, env=env)